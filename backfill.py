@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Resumable maintenance jobs over existing rows, such as reclassifying shorts.
+
+Usage: backfill.py <job> [--days N] [--workers N] [--rate N] [--batch-size N] [--reset]
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import threading
+import time
+
+import models
+import youtube
+
+
+class BackfillError(Exception):
+    """Raised when a job can't make any progress (every request in a batch failed)."""
+
+
+class RateLimiter:
+    """Space out calls (from any number of threads) to at most rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Job:
+    """
+    A maintenance job that processes the rows of a model in id order.
+
+    Rows are handed to process in chunks of chunk_size (one HTTP request per chunk),
+    which should update them in place and return the ones that changed. Changed rows
+    have fields written back in bulk.
+    """
+
+    name = None
+    model = models.Video
+    fields = ()
+    chunk_size = 1
+
+    def query(self):
+        return self.model.select()
+
+    def process(self, rows):
+        raise NotImplementedError
+
+
+class ShortsJob(Job):
+    """Reclassify whether videos are shorts."""
+
+    name = "shorts"
+    fields = (models.Video.short,)
+
+    def __init__(self, days=None):
+        self.days = days
+
+    def query(self):
+        query = models.Video.select()
+
+        if self.days:
+            since = datetime.datetime.now() - datetime.timedelta(days=self.days)
+            query = query.where(models.Video.published > since)
+
+        return query
+
+    def process(self, rows):
+        changed = []
+
+        for video in rows:
+            short = youtube.is_short(video.youtube_id)
+            if video.short != short:
+                video.short = short
+                changed.append(video)
+
+        return changed
+
+
+class ThumbnailsJob(Job):
+    """Re-fetch the thumbnail for videos, 50 per request."""
+
+    name = "thumbnails"
+    fields = (models.Video.thumbnail,)
+    chunk_size = 50
+
+    def process(self, rows):
+        thumbnails = youtube.get_thumbnails([video.youtube_id for video in rows])
+        changed = []
+
+        for video in rows:
+            thumbnail = thumbnails.get(video.youtube_id)
+            if thumbnail and video.thumbnail != thumbnail:
+                video.thumbnail = thumbnail
+                changed.append(video)
+
+        return changed
+
+
+JOBS = {
+    "shorts": ShortsJob,
+    "thumbnails": ThumbnailsJob,
+}
+
+
+def run(job, workers=16, rate=50, batch_size=500, reset=False):
+    """
+    Run a job to completion, resuming from its last checkpoint unless reset is set.
+
+    Each batch of rows is processed by a pool of workers (with requests limited to rate
+    per second, or unlimited if 0), then written back along with the new checkpoint in
+    a single transaction.
+    """
+
+    checkpoint = models.db_writer.write(
+        lambda: models.Checkpoint.get_or_create(name=job.name)[0]
+    )
+    if reset:
+        checkpoint.position = 0
+        models.db_writer.write(checkpoint.save)
+
+    model = job.model
+    total = job.query().where(model.id > checkpoint.position).count()
+    logging.info(f"Running {job.name} job on {total} rows from {checkpoint}")
+
+    limiter = RateLimiter(rate)
+    start = time.perf_counter()
+    position = checkpoint.position
+    blocked = False
+    processed = 0
+    updated = 0
+    failed = 0
+
+    def process(rows):
+        limiter.wait()
+        try:
+            return job.process(rows)
+        except Exception as ex:
+            logging.warning(f"Exception in {job.name} job ({ex})")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, workers),
+        thread_name_prefix=job.name,
+    ) as pool:
+        while True:
+            rows = list(
+                job.query()
+                .where(model.id > position)
+                .order_by(model.id)
+                .limit(batch_size)
+            )
+            if not rows:
+                break
+
+            chunks = list(models.chunked(rows, job.chunk_size))
+            results = list(pool.map(process, chunks))
+            if all(result is None for result in results):
+                raise BackfillError(
+                    f"Every request failed, stopping {job.name} job at {checkpoint}"
+                )
+
+            changed = [row for result in results if result for row in result]
+            failed += results.count(None) * job.chunk_size
+
+            # The checkpoint only moves past chunks that succeeded (and every chunk
+            # before them), so failed rows are retried when the job is next run
+            checkpoint_position = checkpoint.position
+            for chunk, result in zip(chunks, results):
+                blocked = blocked or result is None
+                if blocked:
+                    break
+                checkpoint_position = chunk[-1].id
+
+            def store():
+                if changed:
+                    model.bulk_update(changed, fields=job.fields, batch_size=100)
+
+                checkpoint.position = checkpoint_position
+                checkpoint.updated = datetime.datetime.now()
+                checkpoint.save()
+
+            models.db_writer.write(store)
+
+            position = rows[-1].id
+            processed += len(rows)
+            updated += len(changed)
+            elapsed = time.perf_counter() - start
+            logging.info(
+                f"{job.name}: {processed}/{total} rows ({updated} updated, ~{failed} failed) "
+                f"at {processed / elapsed:.1f} rows/s"
+            )
+
+    if failed:
+        logging.warning(
+            f"~{failed} rows failed in {job.name} job, run it again to retry from {checkpoint}"
+        )
+
+    logging.info(f"Finished {job.name} job in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
+    models.init()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("job", choices=JOBS)
+    parser.add_argument(
+        "--days", type=int, help="only videos published in the last N days"
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument(
+        "--rate", type=float, default=50, help="requests per second (0 = unlimited)"
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--reset", action="store_true", help="start over rather than resuming"
+    )
+    args = parser.parse_args()
+
+    job = ShortsJob(days=args.days) if args.job == "shorts" else JOBS[args.job]()
+    run(
+        job,
+        workers=args.workers,
+        rate=args.rate,
+        batch_size=args.batch_size,
+        reset=args.reset,
+    )
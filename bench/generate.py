@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fill a scratch database with synthetic users, feeds, videos, subscriptions and filters.
+
+Feeds and videos match what the stub YouTube server serves (see bench/stub.py), minus
+each feed's newest new_videos videos, so that refreshing against the stub finds new
+videos just as it would in production.
+
+Usage: python -m bench.generate <database> [--users N] [--feeds N] [--videos N] ...
+"""
+
+import argparse
+import datetime
+import logging
+import random
+
+import migrate
+import models
+from bench import stub
+
+# Every generated user has this password
+PASSWORD = "bench"
+
+
+def channel_id(index):
+    return f"UC{index:022d}"
+
+
+def generate(
+    path,
+    users=100,
+    feeds=500,
+    videos=100,
+    new_videos=5,
+    subscriptions=50,
+    filters=5,
+    seed=0,
+):
+    """
+    Create (or add to) the database at path, returning counts of what was created.
+
+    Each feed has videos - new_videos videos; each user subscribes to subscriptions
+    random feeds and has filters random filters on them.
+    """
+
+    rng = random.Random(seed)
+    models.init(path)
+    migrate.run()
+
+    long_ago = datetime.datetime(2000, 1, 1)
+
+    # Hashing passwords is slow (on purpose), so only do it once
+    password = models.User.password.python_value(
+        models.User.password.db_value(PASSWORD)
+    )
+
+    def create():
+        for batch in models.chunked(range(feeds), 100):
+            models.Feed.insert_many(
+                [
+                    {
+                        "youtube_id": channel_id(index),
+                        "title": f"Channel {channel_id(index)}",
+                        "updated": long_ago,
+                        "logo": f"https://example.com/{channel_id(index)}.jpg",
+                        "description": f"Description of {channel_id(index)}",
+                        "uploads_id": "UU" + channel_id(index)[2:],
+                    }
+                    for index in batch
+                ]
+            ).on_conflict_ignore().execute()
+
+        feed_ids = {
+            feed.youtube_id: feed.id
+            for feed in models.Feed.select(models.Feed.id, models.Feed.youtube_id)
+        }
+
+        rows = (
+            {
+                "youtube_id": stub.video_id(channel_id(index), number),
+                "feed": feed_ids[channel_id(index)],
+                "title": data["snippet"]["title"],
+                "published": data["snippet"]["publishedAt"],
+                "updated": long_ago,
+                "description": data["snippet"]["description"],
+                "thumbnail": data["snippet"]["thumbnails"]["high"]["url"],
+                "short": stub.is_short(data["id"]),
+            }
+            for index in range(feeds)
+            for number in range(max(0, videos - new_videos))
+            for data in [stub.video(channel_id(index), number)]
+        )
+        for batch in models.chunked(rows, 100):
+            models.Video.insert_many(batch).on_conflict_ignore().execute()
+
+        for batch in models.chunked(range(users), 100):
+            models.User.insert_many(
+                [
+                    {"email": f"user{index}@example.com", "password": password}
+                    for index in batch
+                ]
+            ).on_conflict_ignore().execute()
+
+        for user in models.User.select(models.User.id):
+            subscribed = rng.sample(
+                sorted(feed_ids.values()), min(subscriptions, len(feed_ids))
+            )
+            models.Subscription.insert_many(
+                [{"user": user.id, "feed": feed_id} for feed_id in subscribed]
+            ).on_conflict_ignore().execute()
+
+            models.Filter.insert_many(
+                [
+                    {
+                        "user": user.id,
+                        "feed": rng.choice(subscribed),
+                        "filter": rf"Video \d*{rng.randrange(10)} from",
+                        "whitelist": False,
+                    }
+                    for _ in range(filters if subscribed else 0)
+                ]
+            ).execute()
+
+    models.db_writer.write(create)
+
+    for user in models.User.select():
+        models.Timeline.rebuild(user)
+    models.FeedStats.rebuild()
+
+    counts = {
+        "users": models.User.select().count(),
+        "feeds": models.Feed.select().count(),
+        "videos": models.Video.select().count(),
+        "subscriptions": models.Subscription.select().count(),
+        "filters": models.Filter.select().count(),
+        "timeline": models.Timeline.select().count(),
+    }
+    logging.info(
+        "Generated {users} users, {feeds} feeds, {videos} videos, "
+        "{subscriptions} subscriptions, {filters} filters, "
+        "{timeline} timeline entries".format(**counts)
+    )
+
+    return counts
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--feeds", type=int, default=500)
+    parser.add_argument("--videos", type=int, default=100, help="videos per feed")
+    parser.add_argument(
+        "--new-videos",
+        type=int,
+        default=5,
+        help="videos per feed to leave for refreshes to find",
+    )
+    parser.add_argument(
+        "--subscriptions", type=int, default=50, help="subscriptions per user"
+    )
+    parser.add_argument("--filters", type=int, default=5, help="filters per user")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("database")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    generate(
+        args.database,
+        users=args.users,
+        feeds=args.feeds,
+        videos=args.videos,
+        new_videos=args.new_videos,
+        subscriptions=args.subscriptions,
+        filters=args.filters,
+        seed=args.seed,
+    )
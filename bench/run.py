@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark yrss against synthetic data and a stub YouTube server, fully offline.
+
+Each run generates a scratch database (see bench/generate.py), starts the stub (see
+bench/stub.py) and reports throughput and p50/p99 latency for each scenario:
+
+    refresh  refreshing every subscribed feed, first finding new videos and then
+             again when nothing has changed (latency is per feed)
+    render   rendering feeds (/feed/<uuid>.xml), with and without the rendered-feed cache
+    videos   User.get_videos
+    import   importing OPML files of channels that aren't in the database yet, both
+             the request and the background job (latency is per file, throughput
+             of the job is in channels per second)
+
+Usage: python -m bench.run [--scenario NAME ...] [--json] [--latency SECONDS] ...
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import cache
+import importer
+import models
+import quota
+import refresh
+import server
+import youtube
+from bench import generate, stub
+
+SCENARIOS = ("refresh", "render", "videos", "import")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def result(name, latencies, seconds, items=None):
+    """Summarize a scenario, with throughput in items (default, latencies) per second."""
+
+    items = len(latencies) if items is None else items
+
+    return {
+        "scenario": name,
+        "count": len(latencies),
+        "seconds": seconds,
+        "throughput": items / seconds if seconds else 0,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else 0,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else 0,
+    }
+
+
+def measure(name, f, items, concurrency=1):
+    """Call f on each item (from concurrency threads), timing each call and the total."""
+
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        f(item)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, items))
+
+    return result(name, latencies, time.perf_counter() - start)
+
+
+def refresh_scenario(args, rng):
+    feeds = list(
+        models.Feed.select().where(
+            models.Feed.id.in_(models.Subscription.select(models.Subscription.feed))
+        )
+    )
+    results = []
+
+    for name in ("refresh (new videos)", "refresh (not modified)"):
+        latencies = []
+        refresh_feed = refresh.refresh_feed
+
+        def timed(feed):
+            start = time.perf_counter()
+            try:
+                return refresh_feed(feed)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        # refresh_all looks refresh_feed up each time, so time each feed by swapping it
+        refresh.refresh_feed = timed
+        try:
+            stats = refresh.refresh_all(feeds, workers=args.workers, force=True)
+        finally:
+            refresh.refresh_feed = refresh_feed
+
+        results.append(result(name, latencies, stats["seconds"]))
+
+    return results
+
+
+def render_scenario(args, rng):
+    users = list(models.User.select())
+    app = server.create_app()
+
+    def render(user, cached):
+        if not cached:
+            with server.rendered_feeds_lock:
+                server.rendered_feeds.pop(user.id, None)
+
+        response = app.test_client().get(f"/feed/{user.feed_uuid}.xml")
+        assert response.status_code == 200, response.status_code
+
+    results = []
+    for name, cached in (("render (uncached)", False), ("render (cached)", True)):
+        sample = [rng.choice(users) for _ in range(args.requests)]
+        results.append(
+            measure(
+                name,
+                lambda user: render(user, cached),
+                sample,
+                concurrency=args.concurrency,
+            )
+        )
+
+    return results
+
+
+def videos_scenario(args, rng):
+    users = list(models.User.select())
+    sample = [rng.choice(users) for _ in range(args.requests)]
+
+    return [
+        measure(
+            "User.get_videos",
+            lambda user: list(user.get_videos(include_shorts=False)),
+            sample,
+            concurrency=args.concurrency,
+        )
+    ]
+
+
+def opml(channel_ids):
+    outlines = "\n".join(
+        f'<outline text="{id}" title="{id}" type="rss" '
+        f'xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id={id}" />'
+        for id in channel_ids
+    )
+    return f"""<opml version="1.1"><body>
+<outline text="YouTube Subscriptions" title="YouTube Subscriptions">
+{outlines}
+</outline></body></opml>""".encode()
+
+
+def import_scenario(args, rng):
+    # Every import is of new channels, so none of them are cached yet
+    users = list(models.User.select().limit(args.imports))
+    first = models.Feed.select().count() + 1000
+    files = [
+        (
+            user,
+            opml(
+                generate.channel_id(first + i * args.import_channels + j)
+                for j in range(args.import_channels)
+            ),
+        )
+        for i, user in enumerate(users)
+    ]
+
+    # Time the request (parsing and queueing) separately from the background job
+    request_latencies = []
+    latencies = []
+    start = time.perf_counter()
+    for user, data in files:
+        import_start = time.perf_counter()
+        job = importer.create(user, io.BytesIO(data))
+        request_latencies.append(time.perf_counter() - import_start)
+
+        importer.run(job.id)
+        latencies.append(time.perf_counter() - import_start)
+
+    seconds = time.perf_counter() - start
+    return [
+        result("import (request)", request_latencies, sum(request_latencies)),
+        result(
+            f"import ({args.import_channels} channels)",
+            latencies,
+            seconds,
+            items=len(files) * args.import_channels,
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="scenarios to run (default is all of them)",
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="stub response time in seconds"
+    )
+    parser.add_argument("--workers", type=int, default=refresh.YRSS_REFRESH_WORKERS)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--imports", type=int, default=3)
+    parser.add_argument("--import-channels", type=int, default=50)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch files")
+    generate.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.WARNING
+    )
+
+    # Point everything at scratch files and the stub
+    scratch = tempfile.mkdtemp(prefix="yrss-bench-")
+    stub_server = stub.serve(videos=args.videos, latency=args.latency)
+    stub_url = f"http://127.0.0.1:{stub_server.server_address[1]}/"
+    youtube.YRSS_YOUTUBE_API_URL = stub_url + "youtube/v3/"
+    youtube.YRSS_YOUTUBE_URL = stub_url
+    youtube.YRSS_API_KEY = "bench"
+    cache.cache.path = os.path.join(scratch, "cache.db")
+    quota.budget.daily = 0  # unlimited
+
+    try:
+        start = time.perf_counter()
+        counts = generate.generate(
+            os.path.join(scratch, "bench.db"),
+            users=args.users,
+            feeds=args.feeds,
+            videos=args.videos,
+            new_videos=args.new_videos,
+            subscriptions=args.subscriptions,
+            filters=args.filters,
+            seed=args.seed,
+        )
+        generated = time.perf_counter() - start
+
+        rng = random.Random(args.seed)
+        scenarios = {
+            "refresh": refresh_scenario,
+            "render": render_scenario,
+            "videos": videos_scenario,
+            "import": import_scenario,
+        }
+
+        results = []
+        for name in args.scenario or SCENARIOS:
+            results.extend(scenarios[name](args, rng))
+
+    finally:
+        stub_server.shutdown()
+        if args.keep:
+            print(f"Scratch files are in {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"data": counts, "results": results}, indent=2))
+        return
+
+    print(
+        ", ".join(f"{count} {name}" for name, count in counts.items())
+        + f" (generated in {generated:.1f}s)"
+    )
+    print()
+    print(
+        f"{'scenario':<32} {'count':>6} {'per second':>11} {'p50 ms':>9} {'p99 ms':>9}"
+    )
+    for row in results:
+        print(
+            f"{row['scenario']:<32} {row['count']:>6} {row['throughput']:>11.1f} "
+            f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
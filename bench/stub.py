@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A stub of the parts of YouTube that yrss uses, for running offline.
+
+Serves the channels, playlistItems and videos API endpoints (under /youtube/v3/) and
+HEAD /shorts/<id>. Every channel id exists and has the same number of videos, which
+are generated deterministically from the channel id (see video).
+
+Point yrss at it with:
+
+    YRSS_YOUTUBE_API_URL=http://localhost:8765/youtube/v3/
+    YRSS_YOUTUBE_URL=http://localhost:8765/
+
+Usage: python -m bench.stub [--port N] [--videos N] [--latency SECONDS]
+"""
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+# All video timestamps count forward from here, so runs are repeatable
+EPOCH = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+PAGE_SIZE = 50
+
+
+def _hash(value):
+    return int(hashlib.sha1(value.encode()).hexdigest(), 16)
+
+
+def channel(id):
+    return {
+        "id": id,
+        "snippet": {
+            "title": f"Channel {id}",
+            "description": f"Description of {id}",
+            "thumbnails": {"default": {"url": f"https://example.com/{id}.jpg"}},
+        },
+        "contentDetails": {"relatedPlaylists": {"uploads": "UU" + id[2:]}},
+    }
+
+
+def video_id(channel_id, index):
+    """The id of a channel's index-th video (counting from its first)."""
+
+    return f"{channel_id[2:]}-{index}"
+
+
+def video(channel_id, index):
+    """A channel's index-th video, with one upload every 6 hours starting from EPOCH."""
+
+    id = video_id(channel_id, index)
+    published = EPOCH + datetime.timedelta(hours=6 * index)
+
+    return {
+        "id": id,
+        "snippet": {
+            "title": f"Video {index} from {channel_id}",
+            "description": f"Description of video {index}",
+            "publishedAt": published.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "thumbnails": {"high": {"url": f"https://example.com/{id}.jpg"}},
+            "resourceId": {"videoId": id},
+        },
+    }
+
+
+def is_short(id):
+    """About one in ten videos is a short."""
+
+    return _hash(id) % 10 == 0
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Set by serve
+    videos = 0
+    latency = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        time.sleep(self.latency)
+        path = urllib.parse.urlsplit(self.path).path
+
+        if path.startswith("/shorts/"):
+            id = path[len("/shorts/") :]
+            if is_short(id):
+                self._send(200)
+            else:
+                self._send(303, headers={"Location": f"/watch?v={id}"})
+        else:
+            self._send(404)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.rstrip("/").rsplit("/", 1)[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if endpoint == "channels":
+            ids = params.get("id", params.get("forUsername", "")).split(",")
+            self._send(200, {"items": [channel(id) for id in ids if id]})
+
+        elif endpoint == "playlistItems":
+            channel_id = "UC" + params["playlistId"][2:]
+            etag = f'"{channel_id}-{self.videos}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304)
+
+            # Newest first
+            offset = int(params.get("pageToken") or 0)
+            indexes = range(self.videos - 1 - offset, -1, -1)[:PAGE_SIZE]
+            result = {
+                "etag": etag,
+                "items": [video(channel_id, index) for index in indexes],
+            }
+            if offset + PAGE_SIZE < self.videos:
+                result["nextPageToken"] = str(offset + PAGE_SIZE)
+
+            self._send(200, result, headers={"ETag": etag})
+
+        elif endpoint == "videos":
+            items = []
+            for id in params.get("id", "").split(","):
+                prefix, _, index = id.rpartition("-")
+                items.append(dict(video("UC" + prefix, int(index)), id=id))
+            self._send(200, {"items": items})
+
+        else:
+            self._send(404, {"error": {"message": f"Unknown endpoint {endpoint}"}})
+
+
+def serve(port=0, videos=100, latency=0):
+    """
+    Start the stub in a background thread, returning the server.
+
+    Each channel has videos videos; each request waits latency seconds first.
+    server.server_address has the port (if 0 is given, a free one is picked).
+    """
+
+    handler = type("Handler", (Handler,), {"videos": videos, "latency": latency})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--videos", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.videos, args.latency)
+    print(f"Serving on http://localhost:{server.server_address[1]}/")
+    threading.Event().wait()
@@ -0,0 +1,129 @@
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import metrics
+
+YRSS_CACHE_DB = os.getenv("YRSS_CACHE_DB", "yrss2-cache.db")
+YRSS_CACHE_SIZE = int(os.getenv("YRSS_CACHE_SIZE", 100000))
+
+# How many writes to make between evictions
+EVICT_EVERY = 100
+
+
+class Cache:
+    """
+    A persistent TTL cache stored in SQLite.
+
+    Entries survive restarts and are shared between processes using the same file.
+    Expired entries are never returned; once there are more than maxsize entries, the
+    ones closest to expiring are evicted first. Values can be anything that pickles.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        """Each thread gets its own connection, created (with the table) on first use."""
+
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+CREATE TABLE IF NOT EXISTS "cache" (
+    "key" TEXT PRIMARY KEY,
+    "value" BLOB NOT NULL,
+    "expires" REAL NOT NULL
+)
+"""
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS "cache_expires" ON "cache" ("expires")'
+            )
+            self.local.connection = connection
+
+        return self.local.connection
+
+    def get(self, key, default=None):
+        row = (
+            self._connection()
+            .execute(
+                'SELECT "value" FROM "cache" WHERE "key" = ? AND "expires" > ?',
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+
+        with self.lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.cache_requests.inc(cache="api", result="hit" if row else "miss")
+
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO "cache" ("key", "value", "expires") VALUES (?, ?, ?)',
+            (key, pickle.dumps(value), time.time() + ttl),
+        )
+
+        with self.lock:
+            self.writes += 1
+            evict = self.writes % EVICT_EVERY == 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries, then the soonest to expire until there are at most maxsize."""
+
+        connection = self._connection()
+        connection.execute('DELETE FROM "cache" WHERE "expires" <= ?', (time.time(),))
+        connection.execute(
+            """
+DELETE FROM "cache" WHERE "key" IN (
+    SELECT "key" FROM "cache" ORDER BY "expires" DESC LIMIT -1 OFFSET ?
+)
+""",
+            (self.maxsize,),
+        )
+
+    def cached(self, ttl):
+        """Decorator to cache a function's results by its name and (hashable) arguments."""
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args):
+                key = f"{f.__module__}.{f.__name__}:{args!r}"
+
+                value = self.get(key, _missing)
+                if value is _missing:
+                    value = f(*args)
+                    self.set(key, value, ttl)
+
+                return value
+
+            return wrapped
+
+        return decorator
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_missing = object()
+
+cache = Cache(YRSS_CACHE_DB, YRSS_CACHE_SIZE)
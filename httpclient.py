@@ -0,0 +1,66 @@
+import collections
+import os
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+import urllib3
+
+YRSS_HTTP_TIMEOUT = float(os.getenv("YRSS_HTTP_TIMEOUT", 10))  # seconds
+YRSS_HTTP_RETRIES = int(os.getenv("YRSS_HTTP_RETRIES", 3))
+YRSS_HTTP_PER_HOST = int(os.getenv("YRSS_HTTP_PER_HOST", 16))
+
+# Retry connection errors, rate limiting, and server errors with jittered exponential backoff
+# (honoring Retry-After if the server sends one)
+_retry = urllib3.util.Retry(
+    total=YRSS_HTTP_RETRIES,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD"],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# A single session shared by every thread, so connections are kept alive and reused
+session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=YRSS_HTTP_PER_HOST,
+    max_retries=_retry,
+)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+_host_limits = collections.defaultdict(
+    lambda: threading.BoundedSemaphore(YRSS_HTTP_PER_HOST)
+)
+_host_limits_lock = threading.Lock()
+
+
+def request(method, url, **kwargs):
+    """
+    Make a request using the shared session.
+
+    Requests time out after YRSS_HTTP_TIMEOUT seconds unless another timeout is given,
+    and at most YRSS_HTTP_PER_HOST requests are made to any one host at a time.
+    """
+
+    kwargs.setdefault("timeout", YRSS_HTTP_TIMEOUT)
+
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_limits_lock:
+        limit = _host_limits[host]
+
+    with limit:
+        return session.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault("allow_redirects", False)
+    return request("HEAD", url, **kwargs)
@@ -0,0 +1,214 @@
+import concurrent.futures
+import datetime
+import logging
+import os
+import socket
+import urllib.parse
+import xml.etree.ElementTree
+
+import models
+import youtube
+
+YRSS_IMPORT_WORKERS = int(
+    os.getenv("YRSS_IMPORT_WORKERS", 2)
+)  # imports that can run at once (per process)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=YRSS_IMPORT_WORKERS, thread_name_prefix="import"
+)
+
+
+class LeaseLost(Exception):
+    """Raised when another process has claimed an import that was running here."""
+
+
+def worker_name():
+    """This process's name for the imports it's running (see models.ImportJob.claim)."""
+
+    return f"{socket.gethostname()}:{os.getpid()}:import"
+
+
+def parse(file):
+    """
+    Yield the channel id of each YouTube feed in an OPML file (such as YouTube's
+    subscription export), without reading the whole file into memory.
+
+    Raises xml.etree.ElementTree.ParseError if the file isn't valid XML.
+    """
+
+    for _, element in xml.etree.ElementTree.iterparse(file, events=("end",)):
+        if element.tag != "outline":
+            continue
+
+        url = urllib.parse.urlsplit(element.get("xmlUrl", ""))
+        if url.path.endswith("/feeds/videos.xml"):
+            for channel_id in urllib.parse.parse_qs(url.query).get("channel_id", []):
+                yield channel_id
+
+        # Outlines are only needed until they've been read
+        element.clear()
+
+
+def create(user, file):
+    """
+    Queue an import of an OPML file for a user, returning the job (see start).
+
+    The job is leased to this process, which is expected to start it.
+    """
+
+    channel_ids = list(dict.fromkeys(parse(file)))
+
+    return models.db_writer.write(
+        models.ImportJob.create,
+        user=user,
+        channel_ids="\n".join(channel_ids),
+        total=len(channel_ids),
+        worker=worker_name(),
+        expires=_expires(),
+    )
+
+
+def start(job):
+    """Run an import in the background."""
+
+    return _executor.submit(run, job.id)
+
+
+def resume():
+    """
+    Restart any imports that were interrupted (for example, by a restart), once their
+    leases have expired. Returns the ids of the imports that were restarted.
+    """
+
+    ids = models.ImportJob.claim(worker_name())
+    for id in ids:
+        logging.info(f"Resuming import {id}")
+        _executor.submit(run, id)
+
+    return ids
+
+
+def _expires():
+    return datetime.datetime.now() + datetime.timedelta(seconds=models.YRSS_LEASE_TIME)
+
+
+def _update(job, **fields):
+    """Update a job, renewing its lease, unless another process has claimed it."""
+
+    fields["updated"] = datetime.datetime.now()
+    fields["expires"] = _expires()
+
+    updated = (
+        models.ImportJob.update(**fields)
+        .where(
+            (models.ImportJob.id == job.id) & (models.ImportJob.worker == worker_name())
+        )
+        .execute()
+    )
+    if not updated:
+        raise LeaseLost(f"Import {job.id} has been claimed by another process")
+
+    for field, value in fields.items():
+        setattr(job, field, value)
+
+
+def run(job_id):
+    """
+    Subscribe a user to every channel in an import, picking up where it left off.
+
+    Channels are resolved in batches of youtube.CHANNELS_PER_REQUEST, and each
+    batch's feeds and subscriptions are created in a single write along with the
+    job's progress. New feeds aren't refreshed here: they're left for the refresher,
+    which picks up feeds that have never been refreshed first (see models.Lease).
+    """
+
+    with models.db.connection_context():
+        return _run(models.ImportJob.get_by_id(job_id))
+
+
+def _run(job):
+    user = job.user
+    channel_ids = job.channel_ids.split("\n") if job.channel_ids else []
+
+    logging.info(f"Importing {job.total} subscriptions for {user}")
+
+    try:
+        models.db_writer.write(_update, job, status=RUNNING)
+
+        for position in range(
+            job.processed, len(channel_ids), youtube.CHANNELS_PER_REQUEST
+        ):
+            batch = channel_ids[position : position + youtube.CHANNELS_PER_REQUEST]
+
+            existing = {
+                feed.youtube_id
+                for feed in models.Feed.select(models.Feed.youtube_id).where(
+                    models.Feed.youtube_id.in_(batch)
+                )
+            }
+            channels = youtube.get_channels(id for id in batch if id not in existing)
+
+            def store():
+                if channels:
+                    # Marked as never refreshed, so the refresher doesn't skip them
+                    # (see Feed.needs_refresh)
+                    models.Feed.insert_many(
+                        [
+                            dict(channel, updated=datetime.datetime.min)
+                            for channel in channels.values()
+                        ]
+                    ).on_conflict_ignore().execute()
+
+                feed_ids = [
+                    feed.id
+                    for feed in models.Feed.select(models.Feed.id).where(
+                        models.Feed.youtube_id.in_(batch)
+                    )
+                ]
+                if feed_ids:
+                    models.Subscription.insert_many(
+                        [{"user": user.id, "feed": feed_id} for feed_id in feed_ids]
+                    ).on_conflict_ignore().execute()
+
+                _update(
+                    job,
+                    processed=position + len(batch),
+                    subscribed=job.subscribed + len(feed_ids),
+                    not_found=job.not_found + len(batch) - len(feed_ids),
+                )
+
+            models.db_writer.write(store)
+
+        # Existing feeds already have videos, new feeds are added as they're refreshed
+        feed_ids = []
+        for batch in models.chunked(channel_ids, 500):
+            feed_ids.extend(
+                feed.id
+                for feed in models.Feed.select(models.Feed.id).where(
+                    models.Feed.youtube_id.in_(batch)
+                )
+            )
+
+        user.touch()
+        models.Timeline.rebuild(user, feed_ids)
+
+        models.db_writer.write(_update, job, status=DONE)
+        logging.info(
+            f"Imported {job.subscribed} subscriptions for {user} "
+            f"({job.not_found} not found)"
+        )
+
+    except LeaseLost as ex:
+        # Whoever claimed it carries on from the last progress saved
+        logging.warning(f"Stopped importing subscriptions for {user} ({ex})")
+
+    except Exception as ex:
+        logging.warning(f"Exception importing subscriptions for {user} ({ex})")
+        models.db_writer.write(_update, job, status=FAILED, error=str(ex))
+
+    return job
@@ -0,0 +1,153 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    """
+    A metric, with a value for each combination of label values.
+
+    Metrics are registered as they are created and rendered by render(). Values are
+    kept in memory, so each process reports its own.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        """Yield (suffix, labels, value) for each sample of this metric."""
+
+        with self.lock:
+            values = dict(self.values)
+
+        for key, value in sorted(values.items()):
+            yield "", dict(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that is read when metrics are rendered.
+
+    function should return a dict of {(label values, ...): value}.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def samples(self):
+        for labels, value in sorted(self.function().items()):
+            yield "", dict(zip(self.labels, labels)), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * len(self.buckets), 0, 0.0)
+
+            counts, count, total = self.values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[key] = (counts, count + 1, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long a block takes."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {
+                key: (list(counts), count, total)
+                for key, (counts, count, total) in self.values.items()
+            }
+
+        for key, (counts, count, total) in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", dict(labels, le=str(bucket)), cumulative
+
+            yield "_bucket", dict(labels, le="+Inf"), count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+# Shared by every cache (see cache.py, models.User.filter_set and server.get_feed)
+cache_requests = Counter(
+    "yrss_cache_requests_total", "Cache lookups", ["cache", "result"]
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+
+    with _registry_lock:
+        registry = list(_registry)
+
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+
+        for suffix, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join(
+                    f'{label}="{_escape(label_value)}"'
+                    for label, label_value in labels.items()
+                )
+                lines.append(f"{metric.name}{suffix}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{metric.name}{suffix} {value}")
+
+    return "\n".join(lines) + "\n"
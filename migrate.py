@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Apply any pending migrations (in migrations/), or check how the hot queries are planned.
+
+Usage: migrate.py [--list | --explain]
+"""
+
+import argparse
+import datetime
+import importlib.util
+import logging
+import os
+import sys
+
+from peewee import DateTimeField, TextField
+from playhouse.migrate import SqliteMigrator, migrate
+
+import models
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Migrations that were applied by hand before they were recorded, so they're marked as
+# applied (rather than applied again) when an older database is first migrated
+UNRECORDED = ("20240714a-add-short",)
+
+
+class Migration(models.BaseModel):
+    """A migration that has been applied to this database."""
+
+    name = TextField(unique=True)
+    applied = DateTimeField(default=datetime.datetime.now)
+
+    def __str__(self):
+        return f"Migration<{self.name}, {self.applied}>"
+
+
+def add_column(db, table, name, field):
+    """Add a column, unless it already exists (for example, from create_tables)."""
+
+    if name not in [column.name for column in db.get_columns(table)]:
+        migrate(SqliteMigrator(db).add_column(table, name, field))
+
+
+def available():
+    """The name of every migration, in the order they should be applied."""
+
+    return sorted(
+        filename[:-3]
+        for filename in os.listdir(MIGRATIONS_DIR)
+        if filename.endswith(".py")
+    )
+
+
+def pending():
+    models.db_writer.write(track)
+    applied = {migration.name for migration in Migration.select(Migration.name)}
+
+    return [name for name in available() if name not in applied]
+
+
+def track():
+    """
+    Create the migration table, returning True if this is an older database (with
+    tables, but from before migrations were recorded).
+
+    Migrations that were applied by hand back then are recorded as applied.
+    """
+
+    if models.db.table_exists("migration"):
+        return False
+
+    upgrading = models.db.table_exists("feed")
+    Migration.create_table()
+
+    if upgrading:
+        Migration.insert_many(
+            [{"name": name} for name in UNRECORDED]
+        ).on_conflict_ignore().execute()
+
+    return upgrading
+
+
+def run():
+    """Apply each pending migration in order (see apply)."""
+
+    if models.db_writer.write(track):
+        logging.info("Recorded migrations that were applied before they were tracked")
+
+    models.create_tables()
+
+    for name in pending():
+        models.db_writer.write(apply, name)
+
+
+def apply(name):
+    """
+    Apply a migration and record it in the same transaction (on the writer thread).
+
+    Any process may be migrating at the same time, so this checks again that the
+    migration still hasn't been applied once it has the write lock.
+    """
+
+    if Migration.select().where(Migration.name == name).exists():
+        return False
+
+    logging.info(f"Applying migration {name}")
+
+    path = os.path.join(MIGRATIONS_DIR, name + ".py")
+    spec = importlib.util.spec_from_file_location(f"migrations.{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    module.apply(models.db)
+    Migration.create(name=name)
+    return True
+
+
+def hot_queries():
+    """The queries that run most often, for checking their query plans."""
+
+    user = models.User(id=1)
+    feed = models.Feed(id=1)
+
+    return {
+        "User.get_videos": user.videos_query().limit(models.YRSS_RSS_COUNT),
+        "User.get_videos (no shorts)": user.videos_query(include_shorts=False).limit(
+            models.YRSS_RSS_COUNT
+        ),
+        "Feed.get_videos": feed.videos_query().limit(models.YRSS_RSS_COUNT),
+        "Feed.get_videos (no shorts)": feed.videos_query(include_shorts=False).limit(
+            models.YRSS_RSS_COUNT
+        ),
+        "server.get_subscriptions": user.subscriptions_query(),
+        "Lease.claim": models.Lease.due_query(datetime.datetime.now()).limit(50),
+    }
+
+
+def explain():
+    """
+    Print the query plan for each hot query.
+
+    Returns the number of plans that scan an entire table (rather than searching an
+    index) or that need a temporary b-tree to sort, or None if the database is empty.
+    SQLite plans queries against empty tables differently (any plan is as good as
+    another), so this needs a database with feeds and videos in it.
+    """
+
+    if not models.Video.select().exists():
+        print(
+            "Query plans can only be checked against a database with videos in it",
+            file=sys.stderr,
+        )
+        return None
+
+    problems = 0
+
+    for name, query in hot_queries().items():
+        sql, params = query.sql()
+        print(name)
+
+        for _, _, _, detail in models.db.execute_sql(
+            "EXPLAIN QUERY PLAN " + sql, params
+        ):
+            slow = (
+                detail.startswith("SCAN") and "INDEX" not in detail
+            ) or "TEMP B-TREE" in detail
+            problems += slow
+
+            print(f"    {'!' if slow else ' '} {detail}")
+
+    return problems
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
+    models.init()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--list", action="store_true", help="list pending migrations")
+    parser.add_argument(
+        "--explain", action="store_true", help="show query plans for the hot queries"
+    )
+    args = parser.parse_args()
+
+    if args.list:
+        for name in pending():
+            print(name)
+
+    elif args.explain:
+        sys.exit(1 if explain() else 0)
+
+    else:
+        run()
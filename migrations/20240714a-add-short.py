@@ -1,10 +1,7 @@
-import sqlite3
+from peewee import BooleanField
 
-db = sqlite3.connect("yrss2.db")
-db.execute(
-    """
-ALTER TABLE "video" 
-    ADD COLUMN "short" BOOLEAN DEFAULT FALSE;
-"""
-)
-db.commit()
+import migrate
+
+
+def apply(db):
+    migrate.add_column(db, "video", "short", BooleanField(default=False))
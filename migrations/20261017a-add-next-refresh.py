@@ -0,0 +1,7 @@
+from peewee import DateTimeField
+
+import migrate
+
+
+def apply(db):
+    migrate.add_column(db, "feed", "next_refresh", DateTimeField(null=True))
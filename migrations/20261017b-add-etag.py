@@ -0,0 +1,7 @@
+from peewee import TextField
+
+import migrate
+
+
+def apply(db):
+    migrate.add_column(db, "feed", "etag", TextField(null=True))
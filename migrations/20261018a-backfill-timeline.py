@@ -0,0 +1,10 @@
+import logging
+
+import models
+
+
+def apply(db):
+    # Only columns that exist at this point (later migrations add more to User)
+    for user in models.User.select(models.User.id, models.User.email):
+        logging.info(f"Rebuilding timeline for {user}")
+        models.Timeline.rebuild(user)
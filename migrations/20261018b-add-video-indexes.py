@@ -0,0 +1,16 @@
+def apply(db):
+    # Most recent videos for a feed (Feed.get_videos, subscription stats)
+    db.execute_sql(
+        """
+CREATE INDEX IF NOT EXISTS "video_feed_id_published"
+    ON "video" ("feed_id", "published" DESC);
+"""
+    )
+
+    # The same, but only for videos that aren't shorts (as used in feeds)
+    db.execute_sql(
+        """
+CREATE INDEX IF NOT EXISTS "video_feed_id_published_not_short"
+    ON "video" ("feed_id", "published" DESC) WHERE "short" = 0;
+"""
+    )
@@ -0,0 +1,5 @@
+import models
+
+
+def apply(db):
+    models.FeedStats.rebuild()
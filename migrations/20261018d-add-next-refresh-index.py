@@ -0,0 +1,7 @@
+def apply(db):
+    # Feeds that are due to be refreshed, soonest first (Lease.claim)
+    db.execute_sql(
+        """
+CREATE INDEX IF NOT EXISTS "feed_next_refresh" ON "feed" ("next_refresh");
+"""
+    )
@@ -0,0 +1,8 @@
+from peewee import DateTimeField, TextField
+
+import migrate
+
+
+def apply(db):
+    migrate.add_column(db, "importjob", "worker", TextField(null=True))
+    migrate.add_column(db, "importjob", "expires", DateTimeField(null=True))
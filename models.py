@@ -1,33 +1,185 @@
 import cachetools
+import collections
+import contextlib
 import datetime
+import dateutil.parser
 import logging
 import os
 import random
 import re
-import requests
 import string
 import sqlite3
+import threading
+import time
 import uuid
 
 from peewee import (
     Model,
-    SqliteDatabase,
     TextField,
     DateTimeField,
     ForeignKeyField,
     CompositeKey,
     BooleanField,
     UUIDField,
+    IntegerField,
+    JOIN,
+    OperationalError,
+    Case,
+    chunked,
+    fn,
 )
 from peewee_extra_fields import PasswordField
+from playhouse.pool import PooledSqliteDatabase
 
+import metrics
+import writer
 import youtube
 
+YRSS_DB = os.getenv("YRSS_DB", "yrss2.db")
 YRSS_CACHE_TIME = int(os.getenv("YRSS_CACHE_TIME", 60 * 60))  # default = 1 hour
 YRSS_RSS_COUNT = int(os.getenv("YRSS_RSS_COUNT", 100))
-VIDEOS_PER_PAGE = 100
+YRSS_MAX_REFRESH_TIME = int(
+    os.getenv("YRSS_MAX_REFRESH_TIME", 24 * 60 * 60)
+)  # default = 1 day
+YRSS_REFRESH_FACTOR = int(os.getenv("YRSS_REFRESH_FACTOR", 4))
+YRSS_MAX_PAGES = int(os.getenv("YRSS_MAX_PAGES", 10))
+YRSS_DB_POOL_SIZE = int(os.getenv("YRSS_DB_POOL_SIZE", 32))
+YRSS_DB_POOL_TIMEOUT = int(
+    os.getenv("YRSS_DB_POOL_TIMEOUT", 30)
+)  # seconds to wait for a free connection
+YRSS_LEASE_TIME = int(
+    os.getenv("YRSS_LEASE_TIME", 5 * 60)
+)  # default = 5 minutes, renewed while refreshing
 
-db = SqliteDatabase("yrss2.db", timeout=30, check_same_thread=False)
+# Feed fields that are copied from the YouTube channel metadata
+CHANNEL_FIELDS = ("title", "logo", "description", "uploads_id")
+
+# Video fields that are copied from the YouTube playlist items (and may change)
+VIDEO_FIELDS = ("title", "published", "description", "thumbnail")
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+db_locked = metrics.Counter(
+    "yrss_db_locked_total",
+    "Queries that failed because the database was locked (and will be retried later)",
+)
+
+
+class YrssDatabase(PooledSqliteDatabase):
+    """
+    A pool of SQLite connections, with one checked out by each thread that uses it.
+
+    Request threads check one out for the duration of a request (see server.py), so
+    readers don't queue up behind each other on a shared connection. It also counts
+    the queries run on each thread (see count_queries) and how long threads have had
+    to wait for a free connection (see pool_stats).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counters = threading.local()
+        self.stats_lock = threading.Lock()
+        self.connects = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        try:
+            return super().connect(reuse_if_open)
+        finally:
+            waited = time.perf_counter() - start
+            with self.stats_lock:
+                self.connects += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def pool_stats(self):
+        with self.stats_lock:
+            return {
+                "size": self._max_connections,
+                "in_use": len(self._in_use),
+                "idle": len(self._connections),
+                "connects": self.connects,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        except OperationalError as ex:
+            if "locked" in str(ex).lower():
+                db_locked.inc()
+            raise
+        finally:
+            for counter in getattr(self.counters, "active", []):
+                counter.count += 1
+                counter.seconds += time.perf_counter() - start
+
+
+# The database isn't opened on import (see init)
+db = YrssDatabase(
+    None,
+    max_connections=YRSS_DB_POOL_SIZE,
+    timeout=YRSS_DB_POOL_TIMEOUT,
+    check_same_thread=False,
+    pragmas={
+        "journal_mode": "wal",  # readers don't block the writer (or each other)
+        "busy_timeout": 30000,  # 30 seconds
+    },
+)
+
+# All writes go through a single writer thread (see writer.Writer)
+db_writer = writer.Writer(db)
+
+metrics.Gauge(
+    "yrss_db_pool_connections",
+    "Pooled database connections",
+    ["state"],
+    function=lambda: {
+        ("in_use",): db.pool_stats()["in_use"],
+        ("idle",): db.pool_stats()["idle"],
+    },
+)
+metrics.Gauge(
+    "yrss_db_pool_wait_seconds",
+    "Total time spent waiting for a pooled database connection",
+    function=lambda: {(): db.pool_stats()["wait_seconds"]},
+)
+metrics.Gauge(
+    "yrss_db_writes_queued",
+    "Write jobs waiting for the writer thread",
+    function=lambda: {(): db_writer.queue.qsize()},
+)
+
+
+@contextlib.contextmanager
+def count_queries():
+    """
+    Count the queries run on this thread within a block.
+
+    For example, to check that an endpoint stays within a query budget:
+
+        with models.count_queries() as queries:
+            client.get(f"/feed/{user.feed_uuid}.xml")
+        assert queries.count <= 5
+    """
+
+    counter = QueryCounter()
+    active = getattr(db.counters, "active", [])
+    db.counters.active = active + [counter]
+
+    try:
+        yield counter
+    finally:
+        db.counters.active = active
 
 
 class BaseModel(Model):
@@ -35,77 +187,213 @@ class BaseModel(Model):
         database = db
 
 
+class FilterSet:
+    """
+    A user's filters, grouped by feed and compiled into one matcher per feed.
+
+    A video is filtered if its title doesn't match every whitelist pattern for its
+    feed or if it matches any blacklist pattern.
+    """
+
+    def __init__(self, filters):
+        patterns = collections.defaultdict(lambda: ([], []))
+        for filter in filters:
+            patterns[filter.feed_id][0 if filter.whitelist else 1].append(filter.filter)
+
+        self.matchers = {
+            feed_id: (_match_all(whitelist), _match_any(blacklist))
+            for feed_id, (whitelist, blacklist) in patterns.items()
+        }
+
+    def filtered(self, video):
+        if video.feed_id not in self.matchers:
+            return False
+
+        whitelist, blacklist = self.matchers[video.feed_id]
+
+        if whitelist and not whitelist(video.title):
+            return True
+
+        if blacklist and blacklist(video.title):
+            return True
+
+        return False
+
+
+# Patterns with backreferences can't be combined (since group numbers would change)
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def _compile_patterns(patterns):
+    """Compile each pattern, skipping (with a warning) any that aren't valid."""
+
+    regexes = []
+    for pattern in patterns:
+        try:
+            regexes.append(re.compile(pattern, flags=re.IGNORECASE))
+        except re.error as ex:
+            logging.warning(f"Skipping invalid filter {pattern!r} ({ex})")
+
+    return regexes
+
+
+def _combine(regexes, combined, flags=0):
+    """Compile the combined pattern if possible, otherwise return None."""
+
+    if any(_BACKREFERENCE.search(regex.pattern) for regex in regexes):
+        return None
+
+    try:
+        return re.compile(combined, flags=re.IGNORECASE | flags)
+    except re.error:
+        return None
+
+
+def _match_any(patterns):
+    """Build a function that checks if a string matches any of the patterns."""
+
+    regexes = _compile_patterns(patterns)
+    if not regexes:
+        return None
+
+    regex = _combine(regexes, "|".join(f"(?:{regex.pattern})" for regex in regexes))
+    if regex:
+        return lambda text: regex.search(text) is not None
+
+    return lambda text: any(regex.search(text) for regex in regexes)
+
+
+def _match_all(patterns):
+    """Build a function that checks if a string matches all of the patterns."""
+
+    regexes = _compile_patterns(patterns)
+    if not regexes:
+        return None
+
+    regex = _combine(
+        regexes,
+        "".join(f"(?=.*?(?:{regex.pattern}))" for regex in regexes),
+        flags=re.DOTALL,
+    )
+    if regex:
+        return lambda text: regex.match(text) is not None
+
+    return lambda text: all(regex.search(text) for regex in regexes)
+
+
+# Compiled filters by user id, as (User.filters_updated, FilterSet)
+_filter_sets = cachetools.LRUCache(maxsize=1024)
+_filter_sets_lock = threading.Lock()
+
+
 class User(BaseModel):
     email = TextField(unique=True)
     password = PasswordField()
     updated = DateTimeField(default=datetime.datetime.now)
     feed_uuid = UUIDField(default=uuid.uuid4, unique=True)
+    filters_updated = DateTimeField(null=True)
 
     def get_videos(self, n=YRSS_RSS_COUNT, include_shorts=True):
         """Get the n most recent videos, skipping any that don"t match filters."""
 
-        page = 0
-        count = 0
+        for video in self.videos_query(include_shorts).limit(n):
+            yield video
+
+    def videos_query(self, include_shorts=True):
+        """The query behind get_videos (filters were already applied to the timeline)."""
 
-        while True:
-            page += 1
-            empty_page = True
+        videos = (
+            Video.select(Video, Feed)
+            .join(Timeline, on=(Timeline.video == Video.id))
+            .switch(Video)
+            .join(Feed)
+            .where(Timeline.user == self.id)
+            .order_by(Timeline.published.desc())
+        )
 
-            videos = (
-                Video.select()
-                .join(Feed)
-                .join(Subscription)
-                .join(User)
-                .where(User.id == self.id)
-                .order_by(Video.published.desc())
+        if not include_shorts:
+            videos = videos.where(Video.short == False)
+
+        return videos
+
+    def subscriptions_query(self):
+        """This user's subscriptions, along with each feed's video statistics (see FeedStats)."""
+
+        return (
+            Subscription.select(Subscription, Feed, FeedStats)
+            .where(Subscription.user == self.id)
+            .join(Feed, on=(Subscription.feed == Feed.id))
+            .join(
+                FeedStats,
+                JOIN.LEFT_OUTER,
+                on=(Feed.id == FeedStats.feed),
+                attr="stats",
             )
+        )
 
-            if not include_shorts:
-                videos = videos.where(Video.short == False)
+    def filter_set(self):
+        """
+        Get this user's compiled filters.
 
-            videos = videos.paginate(page, VIDEOS_PER_PAGE)
+        These are cached until User.filters_updated changes, which only happens when
+        their filters do (see User.touch_filters).
+        """
 
-            for video in videos:
-                empty_page = False
+        with _filter_sets_lock:
+            cached = _filter_sets.get(self.id)
 
-                if self.filtered(video):
-                    continue
+        hit = cached is not None and cached[0] == self.filters_updated
+        metrics.cache_requests.inc(cache="filter_sets", result="hit" if hit else "miss")
+        if hit:
+            return cached[1]
 
-                yield video
-                count += 1
+        filter_set = FilterSet(Filter.select().where(Filter.user == self.id))
+        with _filter_sets_lock:
+            _filter_sets[self.id] = (self.filters_updated, filter_set)
 
-                if count == n:
-                    return
+        return filter_set
 
-            if empty_page:
-                return
+    def filtered(self, video):
+        return self.filter_set().filtered(video)
 
-    @cachetools.cached(cache=cachetools.TTLCache(1024, 10))
-    def filters_for(self, feed_id):
-        filters = (
-            Filter.select()
-            .join(Feed)
-            .switch(Filter)
-            .join(User)
-            .where(User.id == self.id and Feed.id == feed_id)
+    def touch(self):
+        """Mark this user's feed as changed (see server.get_feed)."""
+
+        self.updated = datetime.datetime.now()
+        db_writer.write(
+            User.update(updated=self.updated).where(User.id == self.id).execute
         )
 
-        return [
-            (re.compile(filter.filter, flags=re.IGNORECASE), filter.whitelist)
-            for filter in filters
-        ]
+    def touch_filters(self):
+        """Mark this user's filters (and so their feed) as changed."""
 
-    def filtered(self, video):
-        for regex, whitelist in self.filters_for(video.feed.id):
-            m = regex.search(video.title)
+        self.updated = self.filters_updated = datetime.datetime.now()
+        db_writer.write(
+            User.update(updated=self.updated, filters_updated=self.filters_updated)
+            .where(User.id == self.id)
+            .execute
+        )
 
-            if not m and whitelist:
-                return True
+    @classmethod
+    def touch_subscribers(cls, feed_ids):
+        """Mark the feed of every user subscribed to any of the given feeds as changed."""
 
-            if m and not whitelist:
-                return True
+        db_writer.write(
+            User.update(updated=datetime.datetime.now())
+            .where(
+                User.id.in_(
+                    Subscription.select(Subscription.user).where(
+                        Subscription.feed.in_(feed_ids)
+                    )
+                )
+            )
+            .execute
+        )
 
-        return False
+    def get_filters(self):
+        """Get this user's filters, along with their feeds."""
+
+        return Filter.select(Filter, Feed).join(Feed).where(Filter.user == self.id)
 
     def __str__(self):
         return f"User<{self.email}>"
@@ -118,19 +406,24 @@ class Feed(BaseModel):
     logo = TextField()
     description = TextField()
     uploads_id = TextField()
+    next_refresh = DateTimeField(null=True)
+    etag = TextField(null=True)
 
     @classmethod
     def create(cls, **kwargs):
         data = youtube.get_channel(kwargs["youtube_id"])
         data.update(kwargs)
 
-        feed = super(Feed, cls).create(**data)
+        feed = db_writer.write(super(Feed, cls).create, **data)
         feed.refresh(force=True)
         return feed
 
-    def refresh(self, force=False):
+    def needs_refresh(self):
         since_last_update = (datetime.datetime.now() - self.updated).total_seconds()
-        if since_last_update < YRSS_CACHE_TIME:
+        return since_last_update >= YRSS_CACHE_TIME
+
+    def refresh(self, force=False):
+        if not self.needs_refresh():
             if force:
                 logging.info(f"Force updating {self}")
             else:
@@ -138,78 +431,220 @@ class Feed(BaseModel):
         else:
             logging.info(f"Refreshing {self}")
 
-        updated_something = False
+        updated_something = bool(Feed.refresh_channels([self]))
+        return self.refresh_videos() or updated_something
 
-        # Update channel metdata
-        self.update(**youtube.get_channel(self.youtube_id))
-        if self.dirty_fields:
-            updated_something = True
-        self.updated = datetime.datetime.now()
-        self.save()
-
-        # Fetch feed and store/update the most recent videos
-        for video_data in youtube.get_videos(self.uploads_id):
-            # Does the video already exist?
-            # If so, check if we need to update any of it's information
-            if (
-                Video.select()
-                .where(Video.youtube_id == video_data["youtube_id"])
-                .exists()
-            ):
-                video = Video.get(youtube_id=video_data["youtube_id"])
-                video.update(**video_data)
-                if video.dirty_fields:
-                    logging.info(f"Updated video with new information: {video}")
-                    updated_something = True
-                    video.save()
-
-            # If the video doesn't exist, create it
-            else:
-                # Check separately if it's a short
-                # Newly created videos should also check if they're shorts
-                # https://stackoverflow.com/questions/71192605/how-do-i-get-youtube-shorts-from-youtube-api-data-v3
-                youtube_id = video_data["youtube_id"]
-                response = requests.head(
-                    f"https://www.youtube.com/shorts/{youtube_id}",
-                    allow_redirects=False,
+    @classmethod
+    def refresh_channels(cls, feeds):
+        """
+        Update channel metadata for many feeds at once.
+
+        Channels are fetched in batches (see youtube.get_channels) and written back in
+        a single bulk update. Returns the feeds whose metadata changed.
+        """
+
+        feeds = list(feeds)
+        channels = youtube.get_channels(feed.youtube_id for feed in feeds)
+        now = datetime.datetime.now()
+
+        found = []
+        changed = []
+        for feed in feeds:
+            if feed.youtube_id not in channels:
+                logging.warning(f"Unable to fetch channel metadata for {feed}")
+                continue
+
+            data = channels[feed.youtube_id]
+            if any(getattr(feed, field) != data[field] for field in CHANNEL_FIELDS):
+                changed.append(feed)
+
+            for field in CHANNEL_FIELDS:
+                setattr(feed, field, data[field])
+            feed.updated = now
+            found.append(feed)
+
+        def store():
+            Feed.bulk_update(
+                found,
+                fields=[
+                    getattr(Feed, field) for field in CHANNEL_FIELDS + ("updated",)
+                ],
+                batch_size=50,
+            )
+
+            if changed:
+                User.touch_subscribers([feed.id for feed in changed])
+
+        if found:
+            db_writer.write(store)
+
+        return changed
+
+    def refresh_videos(self):
+        """Fetch the most recent videos for this feed and store any new or updated ones."""
+
+        # Do all of the network requests (and reads) up front, so that the database
+        # is only held for the writes at the end (other feeds may be refreshing in parallel)
+
+        # Page through the newest videos until we reach ones we already have
+        # (or YRSS_MAX_PAGES pages for a new feed)
+        etag = None
+        videos = {}
+        existing = {}
+
+        try:
+            pages = youtube.get_video_pages(self.uploads_id, etag=self.etag)
+            for page_number, (page_etag, page) in enumerate(pages, 1):
+                if page_number == 1:
+                    etag = page_etag
+
+                page = {video_data["youtube_id"]: video_data for video_data in page}
+                page_existing = {
+                    video.youtube_id: video
+                    for video in Video.select().where(Video.youtube_id.in_(list(page)))
+                }
+
+                videos.update(page)
+                existing.update(page_existing)
+
+                if page_existing or page_number >= YRSS_MAX_PAGES:
+                    break
+
+        # If nothing has changed since the last refresh, there's nothing else to do
+        except youtube.NotModified:
+            logging.debug(f"No new videos for {self}")
+            return False
+
+        rows = []
+        for youtube_id, video_data in videos.items():
+            # If the video already exists, check if we need to update any of it's information
+            if youtube_id in existing:
+                video = existing[youtube_id]
+                if all(
+                    getattr(video, field) == video_data[field] for field in VIDEO_FIELDS
+                ):
+                    continue
+
+                video_data["short"] = video.short
+                logging.info(
+                    f"Updated video with new information: {video_data['title']}, {youtube_id}"
                 )
-                video_data["short"] = not (
-                    response.status_code >= 300 and response.status_code < 400
+
+            # If the video doesn't exist, check separately if it's a short
+            else:
+                video_data["short"] = youtube.is_short(youtube_id)
+                logging.info(f"Created new video: {video_data['title']}, {youtube_id}")
+
+            rows.append(dict(video_data, feed=self.id))
+
+        # Store the etag along with the videos, so it's only used once they've been saved
+        def store():
+            for batch in chunked(rows, 50):
+                Video.insert_many(batch).on_conflict(
+                    conflict_target=[Video.youtube_id],
+                    preserve=[
+                        getattr(Video, field) for field in VIDEO_FIELDS + ("updated",)
+                    ],
+                ).execute()
+
+            if etag != self.etag:
+                self.etag = etag
+                Feed.update(etag=etag).where(Feed.id == self.id).execute()
+
+            if rows:
+                Timeline.add_videos(self, [row["youtube_id"] for row in rows])
+                FeedStats.add_videos(
+                    self,
+                    [
+                        row["published"]
+                        for row in rows
+                        if row["youtube_id"] not in existing
+                    ],
                 )
+                User.touch_subscribers([self.id])
+
+        db_writer.write(store)
+        return bool(rows)
+
+    def refresh_interval(self):
+        """
+        Estimate how long to wait between refreshes based on this feed's upload history.
+
+        Channels are checked YRSS_REFRESH_FACTOR times per typical gap between uploads
+        (or since their last upload, if that's longer), clamped to between
+        YRSS_CACHE_TIME and YRSS_MAX_REFRESH_TIME.
+        """
 
-                video = Video.create(feed=self, **video_data)
-                updated_something = True
-                logging.info(f"Created new video: {video}")
+        published = [
+            _as_datetime(video.published)
+            for video in Video.select(Video.published)
+            .where(Video.feed == self)
+            .order_by(Video.published.desc())
+            .limit(10)
+        ]
+
+        if len(published) < 2:
+            return datetime.timedelta(seconds=YRSS_MAX_REFRESH_TIME)
+
+        gaps = sorted(
+            (newer - older).total_seconds()
+            for newer, older in zip(published, published[1:])
+        )
+        typical_gap = gaps[len(gaps) // 2]
+        since_last = (datetime.datetime.now() - published[0]).total_seconds()
 
-        return updated_something
+        interval = max(typical_gap, since_last) / YRSS_REFRESH_FACTOR
+        interval = max(YRSS_CACHE_TIME, min(YRSS_MAX_REFRESH_TIME, interval))
+        return datetime.timedelta(seconds=interval)
 
-    def is_used(self):
-        """Check if any subscription subscribes to this feed."""
+    def schedule(self):
+        """Set (and store) when this feed should next be refreshed."""
 
-        return Subscription.select().where(Subscription.feed == self).exists()
+        self.next_refresh = datetime.datetime.now() + self.refresh_interval()
+        db_writer.write(
+            Feed.update(next_refresh=self.next_refresh)
+            .where(Feed.id == self.id)
+            .execute
+        )
+        return self.next_refresh
 
     def get_videos(self, n=YRSS_RSS_COUNT, include_shorts=True):
         """Get the n most recent videos"""
 
+        for video in self.videos_query(include_shorts).limit(n):
+            yield video
+
+    def videos_query(self, include_shorts=True):
+        """The query behind get_videos."""
+
         videos = (
-            Video.select()
+            Video.select(Video, Feed)
             .join(Feed)
-            .where(Feed.id == self.id)
+            .where(Video.feed == self.id)
             .order_by(Video.published.desc())
         )
 
         if not include_shorts:
             videos = videos.where(Video.short == False)
 
-        videos = videos.paginate(1, YRSS_RSS_COUNT)
-
-        for video in videos:
-            yield video
+        return videos
 
     def __str__(self):
         return f"Feed<{self.title}, {self.youtube_id}>"
 
 
+def _as_datetime(value):
+    """Convert a stored timestamp (YouTube's are ISO 8601 strings) to a naive local datetime."""
+
+    if isinstance(value, str):
+        value = dateutil.parser.isoparse(value)
+
+    if value.tzinfo:
+        value = value.astimezone().replace(tzinfo=None)
+
+    return value
+
+
 class Video(BaseModel):
     youtube_id = TextField(unique=True)
     feed = ForeignKeyField(Feed, backref="videos")
@@ -254,7 +689,406 @@ class Filter(BaseModel):
         return self.feed.title.lower() < other.feed.title.lower()
 
 
-db.connect()
-db.execute_sql("PRAGMA journal_mode=WAL")
-db.execute_sql("PRAGMA busy_timeout=30000")  # 30 seconds
-db.create_tables([User, Feed, Video, Subscription, Filter])
+class Timeline(BaseModel):
+    """
+    The videos in each user's feed, with filters already applied.
+
+    This is updated as videos are stored (see Feed.refresh_videos) and rebuilt for a
+    user's feeds as their subscriptions and filters change, so that reading a feed is
+    a single range scan.
+    """
+
+    user = ForeignKeyField(User, backref="timeline", index=False)
+    feed = ForeignKeyField(Feed, index=False)
+    video = ForeignKeyField(Video)
+    published = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey("user", "video")
+        indexes = (
+            (("user", "published"), False),
+            (("user", "feed"), False),
+        )
+
+    @classmethod
+    def add_videos(cls, feed, youtube_ids):
+        """Add (or re-add, if they've changed) new videos to the timeline of each subscriber."""
+
+        videos = list(
+            Video.select(Video.id, Video.feed, Video.title, Video.published).where(
+                Video.youtube_id.in_(youtube_ids)
+            )
+        )
+        users = User.select().join(Subscription).where(Subscription.feed == feed.id)
+
+        rows = [
+            {
+                "user": user.id,
+                "feed": feed.id,
+                "video": video.id,
+                "published": video.published,
+            }
+            for user in users
+            for video in videos
+            if not user.filtered(video)
+        ]
+
+        def store():
+            Timeline.delete().where(
+                Timeline.video.in_([video.id for video in videos])
+            ).execute()
+
+            for batch in chunked(rows, 100):
+                Timeline.insert_many(batch).on_conflict_ignore().execute()
+
+        db_writer.write(store)
+
+    @classmethod
+    def rebuild(cls, user, feed_ids=None):
+        """Rebuild a user's timeline, either entirely or just for the given feeds."""
+
+        videos = (
+            Video.select(Video.id, Video.feed, Video.title, Video.published)
+            .join(Subscription, on=(Subscription.feed == Video.feed))
+            .where(Subscription.user == user.id)
+        )
+        delete = Timeline.delete().where(Timeline.user == user.id)
+
+        if feed_ids is not None:
+            videos = videos.where(Video.feed.in_(feed_ids))
+            delete = delete.where(Timeline.feed.in_(feed_ids))
+
+        def store():
+            # Read in the same transaction, so videos added meanwhile (see add_videos)
+            # aren't deleted without being put back
+            rows = [
+                {
+                    "user": user.id,
+                    "feed": video.feed_id,
+                    "video": video.id,
+                    "published": video.published,
+                }
+                for video in videos.iterator()
+                if not user.filtered(video)
+            ]
+
+            delete.execute()
+
+            for batch in chunked(rows, 100):
+                Timeline.insert_many(batch).on_conflict_ignore().execute()
+
+        db_writer.write(store)
+
+    def __str__(self):
+        return f"Timeline<{self.user_id}, {self.video_id}>"
+
+
+class FeedStats(BaseModel):
+    """
+    Video statistics for each feed, so listing subscriptions doesn't need to scan videos.
+
+    These are updated as new videos are stored (see Feed.refresh_videos), while
+    roll_forward (run periodically) drops videos that have aged out of the last 30 days.
+    """
+
+    feed = ForeignKeyField(Feed, primary_key=True)
+    last_published = DateTimeField(null=True)
+    videos_30_days = IntegerField(default=0)
+    videos = IntegerField(default=0)
+
+    @classmethod
+    def add_videos(cls, feed, published):
+        """Count newly stored videos (given when each was published)."""
+
+        if not published:
+            return
+
+        cutoff = _thirty_days_ago()
+        last_published = max(published)
+        videos_30_days = sum(1 for value in published if value > cutoff)
+
+        query = FeedStats.insert(
+            feed=feed.id,
+            last_published=last_published,
+            videos_30_days=videos_30_days,
+            videos=len(published),
+        ).on_conflict(
+            conflict_target=[FeedStats.feed],
+            update={
+                FeedStats.last_published: Case(
+                    None,
+                    [
+                        (
+                            FeedStats.last_published.is_null()
+                            | (FeedStats.last_published < last_published),
+                            last_published,
+                        )
+                    ],
+                    FeedStats.last_published,
+                ),
+                FeedStats.videos_30_days: FeedStats.videos_30_days + videos_30_days,
+                FeedStats.videos: FeedStats.videos + len(published),
+            },
+        )
+        db_writer.write(query.execute)
+
+    @classmethod
+    def roll_forward(cls):
+        """Recount videos from the last 30 days for every feed."""
+
+        query = FeedStats.update(
+            videos_30_days=Video.select(fn.COUNT(Video.id)).where(
+                Video.feed == FeedStats.feed, Video.published > _thirty_days_ago()
+            )
+        )
+        db_writer.write(query.execute)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute all statistics from scratch."""
+
+        stats = (
+            Video.select(
+                Video.feed,
+                fn.MAX(Video.published),
+                fn.SUM(Video.published > _thirty_days_ago()),
+                fn.COUNT(Video.id),
+            )
+            .group_by(Video.feed)
+            .tuples()
+        )
+
+        def store():
+            FeedStats.delete().execute()
+
+            for batch in chunked(stats, 100):
+                FeedStats.insert_many(
+                    batch,
+                    fields=[
+                        FeedStats.feed,
+                        FeedStats.last_published,
+                        FeedStats.videos_30_days,
+                        FeedStats.videos,
+                    ],
+                ).execute()
+
+        db_writer.write(store)
+
+    def __str__(self):
+        return f"FeedStats<{self.feed_id}, {self.videos_30_days}, {self.videos}>"
+
+
+def _thirty_days_ago():
+    """The cutoff for recent videos, formatted the same way YouTube formats Video.published."""
+
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30)
+    return cutoff.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Checkpoint(BaseModel):
+    """How far a maintenance job (see backfill.py) has gotten, so it can be resumed."""
+
+    name = TextField(unique=True)
+    position = IntegerField(default=0)
+    updated = DateTimeField(default=datetime.datetime.now)
+
+    def __str__(self):
+        return f"Checkpoint<{self.name}, {self.position}>"
+
+
+class Lease(BaseModel):
+    """
+    A worker's claim on a feed while it refreshes it, so that no two workers (in any
+    process, see worker.py) refresh the same feed at once.
+
+    Leases are renewed while the refresh is running. If a worker dies, its leases
+    expire and the feeds are claimed by someone else.
+    """
+
+    feed = ForeignKeyField(Feed, primary_key=True)
+    worker = TextField(index=True)
+    expires = DateTimeField()
+
+    @classmethod
+    def due_query(cls, now, by_activity=False):
+        """
+        Subscribed feeds that are due to be refreshed and aren't leased to anyone.
+
+        They're ordered by when they came due, or with by_activity, by uploads in the
+        last 30 days (see FeedStats) with feeds that haven't been fetched yet first,
+        like refresh.within_budget.
+        """
+
+        query = (
+            Feed.select(Feed.id)
+            .join(Lease, JOIN.LEFT_OUTER, on=(Lease.feed == Feed.id))
+            .where(
+                (Feed.next_refresh.is_null() | (Feed.next_refresh <= now))
+                & (Lease.feed.is_null() | (Lease.expires <= now))
+                & fn.EXISTS(
+                    Subscription.select(Subscription.feed).where(
+                        Subscription.feed == Feed.id
+                    )
+                )
+            )
+        )
+
+        if by_activity:
+            return query.join(
+                FeedStats, JOIN.LEFT_OUTER, on=(FeedStats.feed == Feed.id)
+            ).order_by(
+                FeedStats.feed.is_null().desc(),
+                FeedStats.videos_30_days.desc(),
+                Feed.next_refresh,
+            )
+
+        return query.order_by(Feed.next_refresh)
+
+    @classmethod
+    def claim(
+        cls,
+        worker,
+        limit=None,
+        feed_ids=None,
+        lease_time=YRSS_LEASE_TIME,
+        by_activity=False,
+    ):
+        """
+        Lease due feeds to a worker (at most limit, and only from feed_ids if given).
+
+        With by_activity, the most active feeds are claimed first rather than those
+        that have been due the longest (see due_query), for when there isn't enough
+        quota to refresh every due feed.
+
+        Returns the ids of the feeds that were claimed.
+        """
+
+        def claim():
+            now = datetime.datetime.now()
+            query = cls.due_query(now, by_activity)
+            if feed_ids is not None:
+                query = query.where(Feed.id.in_(feed_ids))
+            if limit:
+                query = query.limit(limit)
+
+            ids = [feed.id for feed in query]
+            expires = now + datetime.timedelta(seconds=lease_time)
+            for batch in chunked(ids, 100):
+                Lease.insert_many(
+                    [{"feed": id, "worker": worker, "expires": expires} for id in batch]
+                ).on_conflict_replace().execute()
+
+            return ids
+
+        return db_writer.write(claim)
+
+    @classmethod
+    def renew(cls, worker, lease_time=YRSS_LEASE_TIME):
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=lease_time)
+        db_writer.write(
+            Lease.update(expires=expires).where(Lease.worker == worker).execute
+        )
+
+    @classmethod
+    def release(cls, worker, feed_ids):
+        def release():
+            for batch in chunked(feed_ids, 500):
+                Lease.delete().where(
+                    (Lease.worker == worker) & Lease.feed.in_(batch)
+                ).execute()
+
+        db_writer.write(release)
+
+    def __str__(self):
+        return f"Lease<{self.feed_id}, {self.worker}, {self.expires}>"
+
+
+class QuotaUsage(BaseModel):
+    """YouTube API quota units spent each day, by endpoint and kind of request (see quota.Budget)."""
+
+    day = TextField()
+    endpoint = TextField()
+    kind = TextField()
+    units = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey("day", "endpoint", "kind")
+
+    def __str__(self):
+        return f"QuotaUsage<{self.day}, {self.endpoint}, {self.kind}, {self.units}>"
+
+
+class ImportJob(BaseModel):
+    """An OPML import, run in the background (see importer.py)."""
+
+    user = ForeignKeyField(User, backref="imports")
+    status = TextField(default="pending")  # pending, running, done or failed
+    channel_ids = TextField()  # one per line, in the order they were in the file
+    total = IntegerField(default=0)
+    processed = IntegerField(default=0)
+    subscribed = IntegerField(default=0)
+    not_found = IntegerField(default=0)
+    error = TextField(null=True)
+    created = DateTimeField(default=datetime.datetime.now)
+    updated = DateTimeField(default=datetime.datetime.now)
+    # Which process is running the import, until when (renewed as it makes progress)
+    worker = TextField(null=True)
+    expires = DateTimeField(null=True)
+
+    @classmethod
+    def claim(cls, worker, lease_time=YRSS_LEASE_TIME):
+        """
+        Lease unfinished imports that no process is running (for example, because the
+        one that was has stopped) to a worker, like Lease.claim.
+
+        Returns the ids of the imports that were claimed.
+        """
+
+        def claim():
+            now = datetime.datetime.now()
+            ids = [
+                job.id
+                for job in ImportJob.select(ImportJob.id).where(
+                    ImportJob.status.in_(["pending", "running"])
+                    & (ImportJob.expires.is_null() | (ImportJob.expires <= now))
+                )
+            ]
+
+            if ids:
+                ImportJob.update(
+                    worker=worker, expires=now + datetime.timedelta(seconds=lease_time)
+                ).where(ImportJob.id.in_(ids)).execute()
+
+            return ids
+
+        return db_writer.write(claim)
+
+    def __str__(self):
+        return f"ImportJob<{self.id}, {self.user_id}, {self.status}, {self.processed}/{self.total}>"
+
+
+def init(path=YRSS_DB):
+    """Point the models at a database (it isn't connected to until it's first used)."""
+
+    db.init(path)
+
+
+def create_tables():
+    """Create any missing tables (see migrate.run, which calls this first)."""
+
+    with db.connection_context():
+        db.create_tables(
+            [
+                User,
+                Feed,
+                Video,
+                Subscription,
+                Filter,
+                Timeline,
+                FeedStats,
+                Checkpoint,
+                Lease,
+                QuotaUsage,
+                ImportJob,
+            ]
+        )
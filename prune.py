@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Remove feeds that nobody subscribes to (along with their videos).
+
+Usage: prune.py [--dry-run]
+"""
+
+import argparse
+import logging
+
+from peewee import JOIN, fn
+
+import models
+
+# Feeds to remove per transaction, to keep each one short
+CHUNK_SIZE = 20
+
+
+def prune(dry_run=False, chunk_size=CHUNK_SIZE):
+    """
+    Remove unused feeds and their videos.
+
+    Feeds that still have filters are detached rather than removed: their videos are
+    removed, but the feed (and so the filters) are kept in case someone subscribes again.
+
+    Returns counts of what was (or, with dry_run, would be) removed.
+    """
+
+    has_filters = fn.EXISTS(
+        models.Filter.select(models.Filter.id).where(
+            models.Filter.feed == models.Feed.id
+        )
+    )
+    has_videos = fn.EXISTS(
+        models.Video.select(models.Video.id).where(models.Video.feed == models.Feed.id)
+    )
+
+    unused = (
+        models.Feed.select(models.Feed.id, has_filters.alias("has_filters"))
+        .join(
+            models.Subscription,
+            JOIN.LEFT_OUTER,
+            on=(models.Subscription.feed == models.Feed.id),
+        )
+        .where(
+            models.Subscription.feed.is_null()
+            # Feeds that were already detached have nothing left to remove
+            & ~(has_filters & models.Feed.etag.is_null() & ~has_videos)
+        )
+    )
+
+    deleted = set()
+    detached = set()
+    for feed in unused:
+        (detached if feed.has_filters else deleted).add(feed.id)
+
+    counts = {
+        "deleted_feeds": len(deleted),
+        "detached_feeds": len(detached),
+        "videos": 0,
+    }
+
+    for chunk in models.chunked(sorted(deleted | detached), chunk_size):
+        videos = models.Video.select(models.Video.id).where(
+            models.Video.feed.in_(chunk)
+        )
+
+        if dry_run:
+            counts["videos"] += videos.count()
+            continue
+
+        counts["videos"] += models.db_writer.write(_remove, chunk, detached, deleted)
+
+    logging.info(
+        "{action} {deleted_feeds} unused feeds, detached {detached_feeds} with filters, "
+        "{videos} videos".format(
+            action="Would remove" if dry_run else "Removed",
+            **counts,
+        )
+    )
+
+    return counts
+
+
+def _unsubscribed():
+    return ~fn.EXISTS(
+        models.Subscription.select(models.Subscription.feed).where(
+            models.Subscription.feed == models.Feed.id
+        )
+    )
+
+
+def _remove(chunk, detached, deleted):
+    """
+    Remove (or detach) one chunk of feeds, returning how many videos were removed.
+
+    The feeds were found to be unused before this transaction, so any that have been
+    subscribed to since are left alone.
+    """
+
+    unused = models.Feed.select(models.Feed.id).where(
+        models.Feed.id.in_(chunk) & _unsubscribed()
+    )
+    videos = models.Video.select(models.Video.id).where(models.Video.feed.in_(unused))
+
+    models.Timeline.delete().where(models.Timeline.video.in_(videos)).execute()
+    removed = models.Video.delete().where(models.Video.feed.in_(unused)).execute()
+    models.FeedStats.delete().where(models.FeedStats.feed.in_(unused)).execute()
+
+    # Detached feeds need to fetch all of their videos again if they're reused
+    models.Feed.update(etag=None).where(
+        models.Feed.id.in_([id for id in chunk if id in detached]) & _unsubscribed()
+    ).execute()
+    models.Feed.delete().where(
+        models.Feed.id.in_([id for id in chunk if id in deleted]) & _unsubscribed()
+    ).execute()
+
+    return removed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
+    models.init()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report what would be removed"
+    )
+    args = parser.parse_args()
+
+    prune(dry_run=args.dry_run)
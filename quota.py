@@ -0,0 +1,249 @@
+import collections
+import contextlib
+import datetime
+import logging
+import math
+import os
+import threading
+import time
+import zoneinfo
+
+import metrics
+import models
+import youtube
+
+YRSS_QUOTA_DAILY = int(
+    os.getenv("YRSS_QUOTA_DAILY", 10000)
+)  # units per day, 0 = unlimited
+YRSS_QUOTA_RESERVE = int(
+    os.getenv("YRSS_QUOTA_RESERVE", 1000)
+)  # units held back for interactive requests
+YRSS_QUOTA_BURST = int(
+    os.getenv("YRSS_QUOTA_BURST", 500)
+)  # units refreshes can spend ahead of their rate
+YRSS_QUOTA_SYNC_TIME = int(
+    os.getenv("YRSS_QUOTA_SYNC_TIME", 60)
+)  # seconds between saving (and reloading) usage
+
+# The YouTube API quota resets at midnight Pacific time
+RESET_TIMEZONE = zoneinfo.ZoneInfo("America/Los_Angeles")
+
+INTERACTIVE = "interactive"
+REFRESH = "refresh"
+
+refused = metrics.Counter(
+    "yrss_youtube_quota_refused_total",
+    "YouTube API requests not made because they would go over budget",
+    ["kind"],
+)
+
+
+class QuotaExceeded(Exception):
+    """Raised instead of making a request that the day's budget can't cover."""
+
+
+def _today():
+    """The current quota day, and how many seconds of it have passed."""
+
+    now = datetime.datetime.now(RESET_TIMEZONE)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return now.date().isoformat(), (now - midnight).total_seconds()
+
+
+class Budget:
+    """
+    Track YouTube API quota units spent each day and decide which requests can be made.
+
+    Units are spent as requests are made (see youtube._page), either by refreshes
+    (within refreshing) or interactively (everything else, such as adding a
+    subscription). Refreshes are rate limited like a token bucket: they earn
+    (daily - reserve) units spread evenly over the day, and can spend up to burst
+    units ahead of that. Interactive requests can spend anything that's left, so
+    the reserve is always there for them.
+
+    Usage is saved to the database (see models.QuotaUsage) every sync_time seconds
+    and reloaded at the same time, so it survives restarts and is shared by every
+    process using the same database.
+    """
+
+    def __init__(
+        self,
+        daily=YRSS_QUOTA_DAILY,
+        reserve=YRSS_QUOTA_RESERVE,
+        burst=YRSS_QUOTA_BURST,
+        sync_time=YRSS_QUOTA_SYNC_TIME,
+    ):
+        self.daily = daily
+        self.reserve = reserve
+        self.burst = burst
+        self.sync_time = sync_time
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.day = None
+        self.exhausted = False
+        self.last_sync = None
+
+        # Units by (endpoint, kind) for today, as of the last sync (from every process)
+        self.stored = collections.Counter()
+        # Units by (day, endpoint, kind) spent here that haven't been saved yet
+        self.pending = collections.Counter()
+
+    @contextlib.contextmanager
+    def refreshing(self):
+        """Count requests made by this thread within a block as refreshes."""
+
+        kind = getattr(self.local, "kind", INTERACTIVE)
+        self.local.kind = REFRESH
+        try:
+            yield
+        finally:
+            self.local.kind = kind
+
+    def _roll_over(self, day):
+        if day != self.day:
+            self.day = day
+            self.exhausted = False
+            self.stored = collections.Counter()
+            self.last_sync = None
+
+    def _spent(self, kind=None):
+        return sum(
+            units
+            for (endpoint, units_kind), units in self.stored.items()
+            if kind in (None, units_kind)
+        )
+
+    def _allowance(self, kind, elapsed):
+        if self.exhausted:
+            return 0
+        if not self.daily:
+            return math.inf
+
+        remaining = self.daily - self._spent()
+        if kind == INTERACTIVE:
+            return max(0, remaining)
+
+        limit = self.daily - self.reserve
+        earned = limit * elapsed / (24 * 60 * 60) + self.burst
+        return max(0, min(remaining - self.reserve, earned - self._spent(REFRESH)))
+
+    def allowance(self, kind=REFRESH):
+        """How many units requests of a kind can spend right now."""
+
+        self._sync_if_due()
+
+        day, elapsed = _today()
+        with self.lock:
+            self._roll_over(day)
+            return self._allowance(kind, elapsed)
+
+    def spend(self, endpoint, units):
+        """Spend units on a request, or raise QuotaExceeded if it isn't in the budget."""
+
+        self._sync_if_due()
+
+        kind = getattr(self.local, "kind", INTERACTIVE)
+        day, elapsed = _today()
+        with self.lock:
+            self._roll_over(day)
+
+            if units > self._allowance(kind, elapsed):
+                refused.inc(kind=kind)
+                raise QuotaExceeded(
+                    f"Not enough YouTube API quota left for {kind} requests today"
+                )
+
+            self.stored[(endpoint, kind)] += units
+            self.pending[(day, endpoint, kind)] += units
+
+    def exhaust(self):
+        """Stop spending until tomorrow (when the API says the quota has run out)."""
+
+        day, _ = _today()
+        with self.lock:
+            self._roll_over(day)
+            if not self.exhausted:
+                logging.warning("YouTube API quota exceeded, stopping until tomorrow")
+            self.exhausted = True
+
+    def spent(self):
+        """Units spent today by kind (as of the last sync, plus this process since)."""
+
+        self._sync_if_due()
+
+        day, _ = _today()
+        with self.lock:
+            self._roll_over(day)
+            return {kind: self._spent(kind) for kind in (INTERACTIVE, REFRESH)}
+
+    def _sync_if_due(self):
+        if self.last_sync is None or time.monotonic() - self.last_sync > self.sync_time:
+            self.sync()
+
+    def sync(self):
+        """Save this process's usage and reload today's usage from every process."""
+
+        day, _ = _today()
+        with self.lock:
+            self._roll_over(day)
+            pending, self.pending = self.pending, collections.Counter()
+            # Don't sync again while this one is running
+            self.last_sync = time.monotonic()
+
+        def store():
+            for (pending_day, endpoint, kind), units in pending.items():
+                models.QuotaUsage.insert(
+                    day=pending_day, endpoint=endpoint, kind=kind, units=units
+                ).on_conflict(
+                    conflict_target=[
+                        models.QuotaUsage.day,
+                        models.QuotaUsage.endpoint,
+                        models.QuotaUsage.kind,
+                    ],
+                    update={models.QuotaUsage.units: models.QuotaUsage.units + units},
+                ).execute()
+
+        try:
+            if pending:
+                models.db_writer.write(store)
+
+            stored = collections.Counter(
+                {
+                    (usage.endpoint, usage.kind): usage.units
+                    for usage in models.QuotaUsage.select().where(
+                        models.QuotaUsage.day == day
+                    )
+                }
+            )
+        except Exception as ex:
+            logging.warning(f"Exception saving YouTube API quota usage ({ex})")
+            with self.lock:
+                self.pending.update(pending)
+            return
+
+        with self.lock:
+            if self.day == day:
+                # Add anything spent here since the usage was saved
+                for (pending_day, endpoint, kind), units in self.pending.items():
+                    if pending_day == day:
+                        stored[(endpoint, kind)] += units
+                self.stored = stored
+
+
+def estimate(feeds):
+    """Roughly how many units refreshing some number of feeds will cost."""
+
+    return (
+        feeds + math.ceil(feeds / youtube.CHANNELS_PER_REQUEST)
+    ) * youtube.QUOTA_COST
+
+
+budget = Budget()
+
+metrics.Gauge(
+    "yrss_youtube_quota_spent_units",
+    "YouTube API quota units spent today (by every process, as of the last sync)",
+    ["kind"],
+    function=lambda: {(kind,): units for kind, units in budget.spent().items()},
+)
@@ -0,0 +1,170 @@
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import time
+
+import peewee
+
+import metrics
+import models
+import quota
+
+YRSS_REFRESH_WORKERS = int(os.getenv("YRSS_REFRESH_WORKERS", 8))
+
+pass_seconds = metrics.Histogram(
+    "yrss_refresh_pass_seconds", "Time taken to refresh a batch of feeds"
+)
+feed_seconds = metrics.Histogram(
+    "yrss_refresh_feed_seconds", "Time taken to refresh each feed's videos", ["result"]
+)
+deferred_feeds = metrics.Counter(
+    "yrss_refresh_deferred_total",
+    "Feeds left until a later refresh because there wasn't enough quota",
+)
+
+
+def refresh_feed(feed):
+    """
+    Refresh the videos for a single feed on the current thread.
+
+    Returns True if anything was updated, False if not, and None if the refresh failed.
+    Errors are logged rather than raised so that one bad feed doesn't stop a pass.
+    """
+
+    start = time.perf_counter()
+    result = None
+
+    try:
+        # Each worker thread gets its own connection for the duration of the refresh
+        with models.db.connection_context(), quota.budget.refreshing():
+            result = bool(feed.refresh_videos())
+            return result
+
+    except quota.QuotaExceeded:
+        logging.warning(f"Not enough quota to refresh {feed}, will retry later")
+
+    except (sqlite3.OperationalError, peewee.OperationalError) as ex:
+        if "locked" in str(ex).lower():
+            logging.warning(
+                f"Database locked while refreshing {feed}, will retry later"
+            )
+        else:
+            logging.warning(f"Exception refreshing {feed} ({ex})")
+
+    except Exception as ex:
+        logging.warning(f"Exception refreshing {feed} ({ex})")
+
+    finally:
+        feed_seconds.observe(
+            time.perf_counter() - start,
+            result={True: "updated", False: "unchanged", None: "failed"}[result],
+        )
+
+    return None
+
+
+def within_budget(feeds):
+    """
+    Split feeds into those that fit in the refresh quota budget and those that don't.
+
+    When they don't all fit, the most active feeds (by uploads in the last 30 days,
+    see models.FeedStats) are refreshed first, along with new feeds that haven't
+    been fetched yet. The rest are deferred until their next refresh.
+    """
+
+    allowance = quota.budget.allowance(quota.REFRESH)
+    if quota.estimate(len(feeds)) <= allowance:
+        return feeds, []
+
+    activity = {}
+    for batch in models.chunked([feed.id for feed in feeds], 500):
+        activity.update(
+            (stats.feed_id, stats.videos_30_days)
+            for stats in models.FeedStats.select().where(
+                models.FeedStats.feed.in_(batch)
+            )
+        )
+
+    feeds = sorted(
+        feeds, key=lambda feed: activity.get(feed.id, float("inf")), reverse=True
+    )
+
+    count = 0
+    while count < len(feeds) and quota.estimate(count + 1) <= allowance:
+        count += 1
+
+    return feeds[:count], feeds[count:]
+
+
+def refresh_all(feeds, workers=YRSS_REFRESH_WORKERS, force=False):
+    """
+    Refresh a collection of feeds using a bounded pool of worker threads.
+
+    Channel metadata for all of the feeds is fetched in batches and written in bulk
+    first. Videos are then fetched per feed; most of that is spent waiting on the
+    network, so those waits overlap, while database writes are made in a short
+    transaction per feed at the end of each refresh.
+
+    Feeds that were refreshed within YRSS_CACHE_TIME are skipped unless force is set,
+    and feeds that don't fit in the quota budget are deferred (see within_budget).
+
+    Returns a dict of counts along with the wall time of the pass.
+    """
+
+    feeds = list(feeds)
+    skipped = len(feeds)
+    if not force:
+        feeds = [feed for feed in feeds if feed.needs_refresh()]
+    skipped -= len(feeds)
+
+    feeds, deferred = within_budget(feeds)
+    if deferred:
+        deferred_feeds.inc(len(deferred))
+        logging.warning(
+            f"Not enough quota to refresh every feed, deferring {len(deferred)} "
+            "of the least active"
+        )
+
+    start = time.perf_counter()
+
+    changed_channels = set()
+    try:
+        if feeds:
+            with quota.budget.refreshing():
+                changed_channels = {
+                    feed.id for feed in models.Feed.refresh_channels(feeds)
+                }
+    except Exception as ex:
+        logging.warning(f"Exception refreshing channel metadata ({ex})")
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, workers),
+        thread_name_prefix="refresh",
+    ) as pool:
+        results = list(pool.map(refresh_feed, feeds))
+
+    results = [
+        result or (result is not None and feed.id in changed_channels)
+        for feed, result in zip(feeds, results)
+    ]
+
+    stats = {
+        "feeds": len(feeds),
+        "skipped": skipped,
+        "deferred": len(deferred),
+        "updated": results.count(True),
+        "unchanged": results.count(False),
+        "failed": results.count(None),
+        "workers": workers,
+        "seconds": time.perf_counter() - start,
+    }
+    pass_seconds.observe(stats["seconds"])
+
+    logging.info(
+        "Refreshed {feeds} feeds ({updated} updated, {failed} failed, {skipped} skipped, "
+        "{deferred} deferred) "
+        "in {seconds:.2f}s with {workers} workers".format(**stats)
+    )
+
+    return stats
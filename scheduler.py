@@ -0,0 +1,104 @@
+import datetime
+import heapq
+import logging
+import os
+import time
+
+import models
+import refresh
+import worker
+
+YRSS_SCHEDULE_SYNC_TIME = int(
+    os.getenv("YRSS_SCHEDULE_SYNC_TIME", 10 * 60)
+)  # default = 10 minutes
+
+
+class Scheduler:
+    """
+    Refresh each feed when it is due rather than scanning every feed on a timer.
+
+    Feeds are kept in a priority queue keyed by Feed.next_refresh, which is stored
+    in the database so the schedule survives restarts. After each refresh, a feed is
+    rescheduled based on how often it uploads (see Feed.refresh_interval).
+
+    The queue is periodically reloaded to pick up new feeds and drop removed ones.
+
+    Due feeds are leased (see models.Lease) before they're refreshed, so the scheduler
+    can run alongside standalone workers (see worker.py). Feeds that someone else has
+    leased are dropped until the next reload.
+    """
+
+    def __init__(self, workers=refresh.YRSS_REFRESH_WORKERS):
+        self.workers = workers
+        self.name = worker.worker_name("scheduler")
+        self.queue = []
+        self.last_sync = None
+
+    def sync(self):
+        """Reload the queue from the database, only loading what is needed to order it."""
+
+        # Feeds that nobody subscribes to (see prune.py) don't need to be refreshed
+        self.queue = [
+            (feed.next_refresh or datetime.datetime.min, feed.id)
+            for feed in models.Feed.select(
+                models.Feed.id, models.Feed.next_refresh
+            ).where(
+                models.Feed.id.in_(models.Subscription.select(models.Subscription.feed))
+            )
+        ]
+        heapq.heapify(self.queue)
+        self.last_sync = time.monotonic()
+
+        logging.info(f"Scheduler loaded {len(self.queue)} feeds")
+
+    def due(self, now=None):
+        """Pop the ids of all feeds that are due to be refreshed."""
+
+        now = now or datetime.datetime.now()
+        ids = []
+
+        while self.queue and self.queue[0][0] <= now:
+            ids.append(heapq.heappop(self.queue)[1])
+
+        return ids
+
+    def run_once(self):
+        """Refresh and reschedule any feeds that are due."""
+
+        if (
+            self.last_sync is None
+            or time.monotonic() - self.last_sync > YRSS_SCHEDULE_SYNC_TIME
+        ):
+            self.sync()
+
+        ids = self.due()
+        if not ids:
+            return
+
+        claimed = []
+        for batch in models.chunked(ids, 500):
+            claimed.extend(models.Lease.claim(self.name, feed_ids=batch))
+        if not claimed:
+            return
+
+        for feed in worker.refresh_leased(self.name, claimed, self.workers):
+            heapq.heappush(self.queue, (feed.next_refresh, feed.id))
+
+    def wait_time(self):
+        """How long to sleep until the next feed is due (or the next sync)."""
+
+        wait = YRSS_SCHEDULE_SYNC_TIME
+        if self.queue:
+            until_due = (self.queue[0][0] - datetime.datetime.now()).total_seconds()
+            wait = min(wait, until_due)
+
+        return max(1, wait)
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as ex:
+                logging.warning(f"Exception in scheduler ({ex})")
+
+            time.sleep(self.wait_time())
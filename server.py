@@ -1,25 +1,123 @@
+import cachetools
+import contextlib
 import dateutil.parser
 import flask
 import functools
 import logging
+import os
 import peewee
 import re
-import requests
+import threading
+import time
 import urllib
+import xml.etree.ElementTree
 
+import httpclient
+import importer
+import metrics
+import models
+import quota
 import youtube
 from models import *
 
-app = flask.Flask(__name__)
-app.secret_key = "tAPi7MV9bnhqQyv-k1nfoQ"  # TODO: Config this
+YRSS_SECRET_KEY = os.getenv("YRSS_SECRET_KEY", "tAPi7MV9bnhqQyv-k1nfoQ")
 
+bp = flask.Blueprint("yrss", __name__)
 
-@app.before_request
+# Warn about any request that runs more than this many queries (0 = no limit)
+YRSS_QUERY_BUDGET = int(os.getenv("YRSS_QUERY_BUDGET", 0))
+
+
+request_seconds = metrics.Histogram(
+    "yrss_request_seconds", "Time taken to handle each request", ["endpoint"]
+)
+request_queries = metrics.Counter(
+    "yrss_request_queries_total", "Database queries run by requests", ["endpoint"]
+)
+request_query_seconds = metrics.Counter(
+    "yrss_request_query_seconds_total",
+    "Time spent running database queries for requests",
+    ["endpoint"],
+)
+
+
+def create_app():
+    """
+    Create the web app.
+
+    This has no side effects beyond pointing the models at the database (if that
+    hasn't been done already), so it's cheap to call in each process of a pre-forking
+    WSGI server. Migrations and background refreshing are started separately (see
+    yrss2.py).
+    """
+
+    if models.db.deferred:
+        models.init()
+
+    app = flask.Flask(__name__)
+    app.secret_key = YRSS_SECRET_KEY
+    app.register_blueprint(bp)
+    return app
+
+
+@bp.before_app_request
+def open_connection():
+    # Check out a pooled connection for this request (see models.YrssDatabase)
+    db.connect(reuse_if_open=True)
+
+
+@bp.teardown_app_request
+def close_connection(exception=None):
+    if not db.is_closed():
+        db.close()
+
+
+@bp.before_app_request
+def start_query_count():
+    flask.g.request_start = time.perf_counter()
+    flask.g.query_count = contextlib.ExitStack()
+    flask.g.queries = flask.g.query_count.enter_context(count_queries())
+
+
+@bp.after_app_request
+def check_streamed(response):
+    flask.g.streamed = response.is_streamed
+    return response
+
+
+@bp.teardown_app_request
+def check_query_count(exception=None):
+    # Streamed responses (see stream_feed) keep running queries after the view returns
+    # and are torn down a second time once they've been sent, so count them then
+    if flask.g.pop("streamed", False):
+        return
+
+    query_count = flask.g.pop("query_count", None)
+    if query_count is None:
+        return
+
+    query_count.close()
+
+    endpoint = flask.request.endpoint or "unknown"
+    request_seconds.observe(
+        time.perf_counter() - flask.g.request_start, endpoint=endpoint
+    )
+    request_queries.inc(flask.g.queries.count, endpoint=endpoint)
+    request_query_seconds.inc(flask.g.queries.seconds, endpoint=endpoint)
+
+    if YRSS_QUERY_BUDGET and flask.g.queries.count > YRSS_QUERY_BUDGET:
+        logging.warning(
+            f"{flask.request.endpoint} ran {flask.g.queries.count} queries "
+            f"(budget is {YRSS_QUERY_BUDGET})"
+        )
+
+
+@bp.before_app_request
 def set_user():
     flask.g.user = User.get_or_none(email=flask.session.get("email"))
 
 
-@app.template_filter("urlencode")
+@bp.app_template_filter("urlencode")
 def urlencode(s):
     return urllib.parse.quote_plus(s)
 
@@ -38,7 +136,24 @@ def require_user(f):
     return wrapped
 
 
-@app.route("/")
+def import_opml(user, file):
+    """Start importing an OPML file in the background (see importer.py)."""
+
+    try:
+        job = importer.create(user, file)
+    except xml.etree.ElementTree.ParseError as ex:
+        flask.flash(f"Unable to read OPML file ({ex})")
+        return flask.redirect("/subscriptions")
+
+    importer.start(job)
+    flask.flash(
+        f"Importing {job.total} subscriptions in the background, "
+        f"see /subscriptions/import/{job.id} for progress"
+    )
+    return flask.redirect("/subscriptions")
+
+
+@bp.route("/")
 def home():
     if flask.g.user:
         return flask.render_template("home.html")
@@ -46,7 +161,7 @@ def home():
         return flask.render_template("login.html")
 
 
-@app.route("/profile", methods=["GET", "POST"])
+@bp.route("/profile", methods=["GET", "POST"])
 @require_user
 def profile():
     user = User.get(email=flask.session.get("email"))
@@ -67,33 +182,24 @@ def profile():
 
         else:
             user.password = flask.request.form.get("new-password")
-            user.save()
+            db_writer.write(user.save)
             flask.flash("Password changed")
 
         return flask.redirect("/profile")
 
     # Importing an opml file
     elif flask.request.method == "POST" and "opml" in flask.request.files:
-        file = flask.request.files["opml"]
-
         user = User.get(email=flask.session.get("email"))
-        for youtube_id in re.findall(
-            r'xmlUrl="https://www.youtube.com/feeds/videos.xml\?channel_id=(.*?)"',
-            file.read().decode(),
-        ):
-            feed = Feed.get_or_create(youtube_id=youtube_id)[0]
-            Subscription.get_or_create(user=user, feed=feed)
-
-        return flask.redirect("/subscriptions")
+        return import_opml(user, flask.request.files["opml"])
 
 
-@app.route("/subscriptions", methods=["GET", "POST"])
+@bp.route("/subscriptions", methods=["GET", "POST"])
 @require_user
 def get_subscriptions():
     # Show a subscription page by URL
     if flask.request.method == "GET" and "url" in flask.request.args:
         url = flask.request.args["url"]
-        response = requests.get(url)
+        response = httpclient.get(url)
 
         channel_id_regexes = [
             r'<meta itemprop="channelId" content="(.*?)">',
@@ -115,24 +221,7 @@ def get_subscriptions():
 
     # List subscriptions
     elif flask.request.method == "GET":
-        thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-
-        query = (
-            Subscription.select(
-                Subscription,
-                Feed,
-                peewee.fn.MAX(Video.published).alias("last_published_date"),
-                peewee.fn.COUNT(Video.id).alias("video_count_30_days"),
-            )
-            .where(Subscription.user == flask.g.user)
-            .join(Feed, on=(Subscription.feed == Feed.id))
-            .join(
-                Video,
-                peewee.JOIN.LEFT_OUTER,
-                on=(Feed.id == Video.feed),
-            )
-            .group_by(Subscription, Feed)
-        )
+        query = flask.g.user.subscriptions_query()
 
         return flask.render_template("subscriptions.html", subscriptions=query)
 
@@ -140,6 +229,11 @@ def get_subscriptions():
     elif flask.request.method == "POST" and "id_or_title" in flask.request.form:
         try:
             youtube_id = youtube.get_id(flask.request.form["id_or_title"])
+        except quota.QuotaExceeded:
+            flask.flash(
+                f'Unable to add {flask.request.form["id_or_title"]}, out of YouTube API quota for today'
+            )
+            return flask.redirect("/subscriptions")
         except Exception as ex:
             flask.flash(
                 f'Unable to add {flask.request.form["id_or_title"]}, could not find subscription'
@@ -157,26 +251,55 @@ def get_subscriptions():
             flask.flash(f"Already subscribed to {feed.title}")
             return flask.redirect("/subscriptions")
 
-        Subscription.create(user=User.get(email=flask.session.get("email")), feed=feed)
+        db_writer.write(
+            Subscription.create,
+            user=User.get(email=flask.session.get("email")),
+            feed=feed,
+        )
+        flask.g.user.touch()
+        Timeline.rebuild(flask.g.user, [feed.id])
 
         return flask.redirect("/subscriptions")
 
     # Importing an opml file
     elif flask.request.method == "POST" and "opml" in flask.request.files:
-        file = flask.request.files["opml"]
-
         user = User.get(email=flask.session.get("email"))
-        for youtube_id in re.findall(
-            r'xmlUrl="https://www.youtube.com/feeds/videos.xml\?channel_id=(.*?)"',
-            file.read().decode(),
-        ):
-            feed = Feed.get_or_create(youtube_id=youtube_id)[0]
-            Subscription.get_or_create(user=user, feed=feed)
+        return import_opml(user, flask.request.files["opml"])
+
 
+@bp.route("/subscriptions/import", methods=["POST"])
+@require_user
+def import_subscriptions():
+    if "opml" not in flask.request.files:
+        flask.flash("No OPML file to import")
         return flask.redirect("/subscriptions")
 
+    return import_opml(flask.g.user, flask.request.files["opml"])
+
+
+@bp.route("/subscriptions/import/<int:id>", methods=["GET"])
+@require_user
+def get_import(id):
+    job = ImportJob.get_or_none(id=id, user=flask.g.user)
+    if not job:
+        flask.abort(404)
+
+    return flask.jsonify(
+        {
+            "id": job.id,
+            "status": job.status,
+            "total": job.total,
+            "processed": job.processed,
+            "subscribed": job.subscribed,
+            "not_found": job.not_found,
+            "error": job.error,
+            "created": job.created.isoformat(),
+            "updated": job.updated.isoformat(),
+        }
+    )
+
 
-@app.route("/subscriptions/<youtube_id>", methods=["GET", "POST", "DELETE"])
+@bp.route("/subscriptions/<youtube_id>", methods=["GET", "POST", "DELETE"])
 @require_user
 def get_single_subscription(youtube_id):
     # Display a single subscription
@@ -199,19 +322,21 @@ def get_single_subscription(youtube_id):
     ):
         user = User.get(email=flask.session.get("email"))
         feed = Feed.get(youtube_id=youtube_id)
-        Subscription.get(user=user, feed=feed).delete_instance()
+        db_writer.write(Subscription.get(user=user, feed=feed).delete_instance)
+        user.touch()
+        Timeline.rebuild(user, [feed.id])
 
         return flask.redirect("/subscriptions")
 
 
-@app.route("/filters", methods=["GET", "POST"])
+@bp.route("/filters", methods=["GET", "POST"])
 @require_user
 def get_feeds():
     # Display current filters, preload if given that option
     if flask.request.method == "GET":
         return flask.render_template(
             "filters.html",
-            filters=flask.g.user.filters,
+            filters=flask.g.user.get_filters(),
             channel=flask.request.args.get("channel"),
             filter=flask.request.args.get("filter"),
         )
@@ -227,21 +352,24 @@ def get_feeds():
             re.compile(filter, flags=re.IGNORECASE)
         except re.error as ex:
             flask.flash(f"Unable to compile regexp: {ex}")
-            flask.redirect("/filters")
+            return flask.redirect("/filters")
 
         feed = Feed.get(youtube_id=youtube_id)
 
-        Filter.create(
+        db_writer.write(
+            Filter.create,
             user=User.get(email=flask.session.get("email")),
             feed=feed,
             filter=filter,
             whitelist=whitelist,
         )
+        flask.g.user.touch_filters()
+        Timeline.rebuild(flask.g.user, [feed.id])
 
         return flask.redirect("/filters")
 
 
-@app.route("/filters/<id>", methods=["GET", "POST", "DELETE"])
+@bp.route("/filters/<id>", methods=["GET", "POST", "DELETE"])
 @require_user
 def get_single_filters(id):
     filter = Filter.get(id=id)
@@ -252,10 +380,13 @@ def get_single_filters(id):
         raise NotImplementedError
 
     elif flask.request.method == "POST" and "action-save" in flask.request.form:
+        old_feed_id = filter.feed_id
         filter.feed = Feed.get(Feed.youtube_id == flask.request.form.get("youtube_id"))
         filter.filter = flask.request.form.get("filter")
         filter.whitelist = flask.request.form.get("whitelist", "off").lower() == "on"
-        filter.save()
+        db_writer.write(filter.save)
+        flask.g.user.touch_filters()
+        Timeline.rebuild(flask.g.user, [old_feed_id, filter.feed_id])
 
         flask.flash("Filter saved")
 
@@ -267,13 +398,15 @@ def get_single_filters(id):
         if filter.user != User.get(email=flask.session.get("email")):
             flask.abort(403)
 
-        filter.delete_instance()
+        db_writer.write(filter.delete_instance)
+        flask.g.user.touch_filters()
+        Timeline.rebuild(flask.g.user, [filter.feed_id])
         flask.flash("Filter deleted")
 
     return flask.redirect("/filters")
 
 
-@app.route("/videos", methods=["GET"])
+@bp.route("/videos", methods=["GET"])
 @require_user
 def get_videos():
     # Display current most recent videos
@@ -285,39 +418,140 @@ def get_videos():
         )
 
 
-@app.route("/videos/<youtube_id>", methods=["GET"])
+@bp.route("/videos/<youtube_id>", methods=["GET"])
 @require_user
 def get_single_feed(youtube_id):
     feed = Feed.get(youtube_id=youtube_id)
-    videos = Video.select().join(Feed).where(Feed.id == feed.id)
+    videos = Video.select(Video, Feed).join(Feed).where(Feed.id == feed.id)
 
     return flask.render_template("videos.html", title=feed.title, videos=videos)
 
 
-@app.route("/feed/<uuid>.xml", methods=["GET"])
+class LatestUpdate:
+    """
+    Track the latest time any video was updated as a feed is rendered.
+
+    This lets a feed be generated in a single pass; the feed's updated element comes
+    after its entries (Atom doesn't care about the order of elements in a feed).
+    """
+
+    def __init__(self, updated):
+        self.updated = updated
+
+    def track(self, videos):
+        for video in videos:
+            self.updated = max(self.updated, video.updated)
+            yield video
+
+
+@flask.stream_with_context
+def stream_feed(path, title, updated, videos, chunk_size=8192):
+    """Render a feed as it's sent, in chunks of at least chunk_size characters."""
+
+    latest = LatestUpdate(updated)
+    chunk = []
+    length = 0
+
+    for part in flask.stream_template(
+        "feed.xml",
+        title=title,
+        path=path,
+        latest=latest,
+        videos=latest.track(videos),
+    ):
+        chunk.append(part)
+        length += len(part)
+
+        if length >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+
+    yield "".join(chunk)
+
+
+# Rendered feeds by user id, as (etag, body)
+# Feeds are re-rendered whenever User.updated changes (see User.touch)
+rendered_feeds = cachetools.LRUCache(maxsize=1024)
+rendered_feeds_lock = threading.Lock()
+
+
+def cache_feed(user_id, etag, chunks):
+    """Pass through a streamed feed, caching the whole thing once it's complete."""
+
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+
+    with rendered_feeds_lock:
+        rendered_feeds[user_id] = (etag, "".join(body))
+
+
+@bp.route("/feed/<uuid>.xml", methods=["GET"])
 def get_feed(uuid):
     user = User.get(feed_uuid=uuid)
-    videos = user.get_videos(include_shorts=False)  # TODO: Parameterize this
-    updated = user.updated
 
-    for video in videos:
-        updated = max(updated, video.updated)
+    # User.updated changes whenever anything in the feed might have, so if the client
+    # already has this version, there's nothing else to do
+    etag = f"{user.id}-{user.updated.timestamp()}"
+    last_modified = user.updated.astimezone(datetime.timezone.utc).replace(
+        microsecond=0
+    )
 
-    return flask.Response(
-        flask.render_template(
-            "feed.xml",
-            title=user.email,
-            path=f"/feed/{user.feed_uuid}.xml",
-            updated=updated,
-            videos=user.get_videos(
-                include_shorts=False
-            ),  # TODO: Why is this fetched twice?
-        ),
-        mimetype="application/atom+xml",
+    if flask.request.if_none_match:
+        not_modified = flask.request.if_none_match.contains(etag)
+    else:
+        since = flask.request.if_modified_since
+        not_modified = bool(since and since >= last_modified)
+
+    if not_modified:
+        response = flask.Response(status=304)
+
+    else:
+        with rendered_feeds_lock:
+            cached_etag, body = rendered_feeds.get(user.id, (None, None))
+
+        metrics.cache_requests.inc(
+            cache="rendered_feeds", result="hit" if cached_etag == etag else "miss"
+        )
+        if cached_etag != etag:
+            body = cache_feed(
+                user.id,
+                etag,
+                stream_feed(
+                    path=f"/feed/{user.feed_uuid}.xml",
+                    title=user.email,
+                    updated=user.updated,
+                    videos=user.get_videos(
+                        include_shorts=False
+                    ),  # TODO: Parameterize this
+                ),
+            )
+
+        response = flask.Response(body, mimetype="application/atom+xml")
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+@bp.app_errorhandler(quota.QuotaExceeded)
+def quota_exceeded(exception):
+    # Feed readers should retry later (quota is spread over the day, see quota.Budget)
+    response = flask.Response(
+        "Out of YouTube API quota, try again later", status=503, mimetype="text/plain"
     )
+    response.retry_after = 60 * 60
+    return response
+
+
+@bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
-@app.route("/login", methods=["POST"])
+@bp.route("/login", methods=["POST"])
 def login():
     email = flask.request.form["email"]
     password = flask.request.form["password"]
@@ -339,13 +573,13 @@ def login():
     return flask.redirect("/")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     del flask.session["email"]
     return flask.redirect("/")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if flask.request.method == "GET":
         return flask.render_template("register.html")
@@ -357,8 +591,7 @@ def register():
             flask.flash("Username already taken")
             return flask.redirect("/register")
 
-        user = User.create(email=email, password=password)
-        user.save()
+        user = db_writer.write(User.create, email=email, password=password)
 
         flask.flash("New user created")
         flask.session["email"] = email
@@ -372,20 +605,21 @@ def register():
 
 
 # Legacy compatibility
-@app.route("/user/<id_or_username>.xml")
-@app.route("/user/<id_or_username>/atom.xml")
-@app.route("/channel/<id_or_username>.xml")
-@app.route("/channel/<id_or_username>/atom.xml")
-@app.route("/legacy/<id_or_username>.xml")
+@bp.route("/user/<id_or_username>.xml")
+@bp.route("/user/<id_or_username>/atom.xml")
+@bp.route("/channel/<id_or_username>.xml")
+@bp.route("/channel/<id_or_username>/atom.xml")
+@bp.route("/legacy/<id_or_username>.xml")
 def legacy(id_or_username):
     youtube_id = youtube.get_id(id_or_username)
-    feed = Feed.get_or_create(youtube_id=youtube_id)[0]
+    feed = Feed.get_or_none(youtube_id=youtube_id)
+    if not feed:
+        feed = Feed.create(youtube_id=youtube_id)
 
     return flask.Response(
-        flask.render_template(
-            "feed.xml",
-            title=feed.title,
+        stream_feed(
             path=f"/legacy/{feed.youtube_id}.xml",
+            title=feed.title,
             updated=feed.updated,
             videos=feed.get_videos(),
         ),
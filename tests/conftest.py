@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import cache
+import migrate
+import models
+
+
+@pytest.fixture(scope="session")
+def database(tmp_path_factory):
+    """A scratch database (and API cache), migrated once for the whole run."""
+
+    path = tmp_path_factory.mktemp("yrss")
+    cache.cache.path = str(path / "cache.db")
+    models.init(str(path / "yrss2.db"))
+    migrate.run()
+
+    return models.db
+
+
+@pytest.fixture
+def db(database):
+    """The scratch database, emptied after each test."""
+
+    yield database
+
+    def clear():
+        for table in database.get_tables():
+            if table != "migration":
+                database.execute_sql(f'DELETE FROM "{table}"')
+
+    models.db_writer.write(clear)
+    models._filter_sets.clear()
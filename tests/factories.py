@@ -0,0 +1,42 @@
+"""Rows for tests, written through the writer like the app's own writes."""
+
+import datetime
+
+import models
+
+
+def create(model, **data):
+    # Inserted directly, as Feed.create fetches the channel from YouTube
+    id = models.db_writer.write(model.insert(**data).execute)
+    return model.get_by_id(id) if model._meta.primary_key.name == "id" else None
+
+
+def make_feed(youtube_id="UC0", videos=0):
+    feed = create(
+        models.Feed,
+        youtube_id=youtube_id,
+        title=f"Channel {youtube_id}",
+        logo="logo",
+        description="",
+        uploads_id="UU" + youtube_id[2:],
+        etag="etag",
+    )
+
+    for index in range(videos):
+        create(
+            models.Video,
+            youtube_id=f"{youtube_id}-{index}",
+            feed=feed,
+            title=f"Video {index}",
+            published=f"2026-10-{index + 1:02d}T00:00:00Z",
+            updated=datetime.datetime.now(),
+            description="",
+            thumbnail="thumbnail",
+            short=False,
+        )
+
+    return feed
+
+
+def make_user(email="user@example.com"):
+    return create(models.User, email=email, password="password")
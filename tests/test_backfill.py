@@ -0,0 +1,73 @@
+import pytest
+
+import backfill
+import models
+from factories import make_feed
+
+
+class TitleJob(backfill.Job):
+    """Upper-case video titles, failing for any video in fail."""
+
+    name = "titles"
+    fields = (models.Video.title,)
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+
+    def process(self, rows):
+        if any(video.youtube_id in self.fail for video in rows):
+            raise ValueError("request failed")
+
+        for video in rows:
+            video.title = video.title.upper()
+        return rows
+
+
+def titles():
+    return [video.title for video in models.Video.select().order_by(models.Video.id)]
+
+
+def checkpoint():
+    return models.Checkpoint.get(name="titles").position
+
+
+def test_failed_rows_are_retried_on_the_next_run(db):
+    make_feed("UC0", videos=6)
+    ids = [video.id for video in models.Video.select().order_by(models.Video.id)]
+
+    backfill.run(TitleJob(fail={"UC0-2"}), workers=2, rate=0, batch_size=2)
+
+    # Everything else was processed, but the checkpoint stops before the failure
+    assert titles() == [
+        "VIDEO 0",
+        "VIDEO 1",
+        "Video 2",
+        "VIDEO 3",
+        "VIDEO 4",
+        "VIDEO 5",
+    ]
+    assert checkpoint() == ids[1]
+
+    backfill.run(TitleJob(), workers=2, rate=0, batch_size=2)
+
+    assert titles() == [f"VIDEO {index}" for index in range(6)]
+    assert checkpoint() == ids[-1]
+
+
+def test_job_stops_when_every_request_fails(db):
+    make_feed("UC0", videos=2)
+
+    with pytest.raises(backfill.BackfillError):
+        backfill.run(TitleJob(fail={"UC0-0", "UC0-1"}), rate=0)
+
+    assert checkpoint() == 0
+
+
+def test_reset_starts_over(db):
+    make_feed("UC0", videos=2)
+    backfill.run(TitleJob(), rate=0)
+
+    models.db_writer.write(models.Video.update(title="Video").execute)
+    backfill.run(TitleJob(), rate=0, reset=True)
+
+    assert titles() == ["VIDEO", "VIDEO"]
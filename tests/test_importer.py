@@ -0,0 +1,151 @@
+import datetime
+import io
+
+import pytest
+
+import importer
+import models
+import server
+from factories import create, make_feed, make_user
+
+OPML = b"""<?xml version="1.0"?>
+<opml version="1.1">
+  <body>
+    <outline text="YouTube Subscriptions" title="YouTube Subscriptions">
+      <outline text="Old" xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id=UC0" />
+      <outline text="New" xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id=UCnew" />
+      <outline text="Gone" xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id=UCgone" />
+      <outline text="Again" xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id=UC0" />
+      <outline text="Blog" xmlUrl="https://example.com/feed.xml" />
+    </outline>
+  </body>
+</opml>
+"""
+
+
+@pytest.fixture
+def channels(monkeypatch):
+    """Look up channels without YouTube, recording which were asked for."""
+
+    requested = []
+
+    def get_channels(ids):
+        ids = list(ids)
+        requested.extend(ids)
+        return {
+            id: {
+                "youtube_id": id,
+                "title": f"Channel {id}",
+                "logo": "logo",
+                "description": "",
+                "uploads_id": "UU" + id[2:],
+            }
+            for id in ids
+            if id != "UCgone"
+        }
+
+    monkeypatch.setattr(importer.youtube, "get_channels", get_channels)
+    return requested
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    # Run imports as they're started, rather than in the background
+    monkeypatch.setattr(importer, "start", lambda job: importer.run(job.id))
+    return server.create_app().test_client()
+
+
+def log_in(client, user):
+    with client.session_transaction() as session:
+        session["email"] = user.email
+
+
+def test_parse():
+    assert list(importer.parse(io.BytesIO(OPML))) == ["UC0", "UCnew", "UCgone", "UC0"]
+
+
+def test_import_subscribes_in_bulk(client, channels):
+    user = make_user()
+    make_feed("UC0", videos=2)
+    log_in(client, user)
+
+    response = client.post(
+        "/subscriptions/import", data={"opml": (io.BytesIO(OPML), "subs.xml")}
+    )
+    assert response.status_code == 302
+
+    # Only channels without feeds are looked up
+    assert channels == ["UCnew", "UCgone"]
+
+    job = models.ImportJob.get(user=user.id)
+    status = client.get(f"/subscriptions/import/{job.id}").get_json()
+    assert {key: status[key] for key in ("status", "total", "processed")} == {
+        "status": importer.DONE,
+        "total": 3,
+        "processed": 3,
+    }
+    assert (status["subscribed"], status["not_found"]) == (2, 1)
+
+    subscribed = models.Feed.select().join(models.Subscription)
+    assert sorted(feed.youtube_id for feed in subscribed) == ["UC0", "UCnew"]
+
+    # New feeds are left for the refresher, existing feeds' videos are in the timeline
+    assert models.Feed.get(youtube_id="UCnew").updated == datetime.datetime.min
+    assert models.Timeline.select().count() == 2
+
+
+def test_import_status_is_private(client, channels):
+    user = make_user()
+    job = importer.create(user, io.BytesIO(OPML))
+
+    log_in(client, make_user("other@example.com"))
+    assert client.get(f"/subscriptions/import/{job.id}").status_code == 404
+
+
+def test_interrupted_import_is_claimed_once_its_lease_expires(db, channels):
+    user = make_user()
+    expired = create(
+        models.ImportJob,
+        user=user,
+        status=importer.RUNNING,
+        channel_ids="UC0\nUCnew",
+        total=2,
+        worker="elsewhere",
+        expires=datetime.datetime.now() - datetime.timedelta(seconds=1),
+    )
+    running = create(
+        models.ImportJob,
+        user=user,
+        status=importer.RUNNING,
+        channel_ids="UCgone",
+        total=1,
+        worker="elsewhere",
+        expires=datetime.datetime.now() + datetime.timedelta(minutes=5),
+    )
+
+    assert models.ImportJob.claim(importer.worker_name()) == [expired.id]
+    assert models.ImportJob.claim("another") == []
+
+    job = importer.run(expired.id)
+    assert (job.status, job.subscribed) == (importer.DONE, 2)
+
+    # Finished imports aren't claimed again, even once their leases expire
+    models.db_writer.write(
+        models.ImportJob.update(expires=datetime.datetime.now()).execute
+    )
+    assert models.ImportJob.claim("another") == [running.id]
+
+
+def test_import_stops_if_claimed_elsewhere(db, channels):
+    job = importer.create(make_user(), io.BytesIO(OPML))
+    models.db_writer.write(
+        models.ImportJob.update(worker="elsewhere")
+        .where(models.ImportJob.id == job.id)
+        .execute
+    )
+
+    job = importer.run(job.id)
+
+    # Left for whoever claimed it, rather than failed
+    assert models.ImportJob.get_by_id(job.id).status == importer.PENDING
+    assert models.Subscription.select().count() == 0
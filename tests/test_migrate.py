@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+MIGRATE = (
+    "import logging, migrate, models; logging.basicConfig(level=logging.INFO); "
+    "models.init(); migrate.run()"
+)
+
+
+def migrate(path, script=MIGRATE):
+    """Run migrations in a separate process (models.db is already in use here)."""
+
+    return subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        env=dict(os.environ, YRSS_DB=str(path), YRSS_CACHE_DB=str(path) + ".cache"),
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+# The schema from before migrations were tracked (with video.short, which was added by
+# hand back then), as created by the original models
+BASELINE = """
+CREATE TABLE "feed" ("id" INTEGER NOT NULL PRIMARY KEY, "youtube_id" TEXT NOT NULL, "title" TEXT NOT NULL, "updated" DATETIME NOT NULL, "logo" TEXT NOT NULL, "description" TEXT NOT NULL, "uploads_id" TEXT NOT NULL);
+CREATE UNIQUE INDEX "feed_youtube_id" ON "feed" ("youtube_id");
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "email" TEXT NOT NULL, "password" BLOB NOT NULL, "updated" DATETIME NOT NULL, "feed_uuid" TEXT NOT NULL);
+CREATE UNIQUE INDEX "user_email" ON "user" ("email");
+CREATE UNIQUE INDEX "user_feed_uuid" ON "user" ("feed_uuid");
+CREATE TABLE "filter" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" INTEGER NOT NULL, "feed_id" INTEGER NOT NULL, "filter" TEXT NOT NULL, "whitelist" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("feed_id") REFERENCES "feed" ("id"));
+CREATE INDEX "filter_user_id" ON "filter" ("user_id");
+CREATE INDEX "filter_feed_id" ON "filter" ("feed_id");
+CREATE TABLE "subscription" ("user_id" INTEGER NOT NULL, "feed_id" INTEGER NOT NULL, PRIMARY KEY ("user_id", "feed_id"), FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("feed_id") REFERENCES "feed" ("id"));
+CREATE INDEX "subscription_user_id" ON "subscription" ("user_id");
+CREATE INDEX "subscription_feed_id" ON "subscription" ("feed_id");
+CREATE TABLE "video" ("id" INTEGER NOT NULL PRIMARY KEY, "youtube_id" TEXT NOT NULL, "feed_id" INTEGER NOT NULL, "title" TEXT NOT NULL, "published" DATETIME NOT NULL, "updated" DATETIME NOT NULL, "description" TEXT NOT NULL, "thumbnail" TEXT NOT NULL, "short" INTEGER NOT NULL, FOREIGN KEY ("feed_id") REFERENCES "feed" ("id"));
+CREATE UNIQUE INDEX "video_youtube_id" ON "video" ("youtube_id");
+CREATE INDEX "video_feed_id" ON "video" ("feed_id");
+
+INSERT INTO "user" VALUES (1, 'user@example.com', X'00', '2024-07-01 00:00:00', 'c5d0f6a4-6a4e-4f4a-9d0e-3c0b8f1f2f10');
+INSERT INTO "feed" VALUES (1, 'UC0', 'Channel', '2024-07-01 00:00:00', '', '', 'UU0');
+INSERT INTO "subscription" VALUES (1, 1);
+INSERT INTO "filter" VALUES (1, 1, 1, 'skip', 0);
+INSERT INTO "video" VALUES (1, 'video-1', 1, 'Video', '2024-07-01T00:00:00Z', '2024-07-01T00:00:00Z', '', '', 0);
+INSERT INTO "video" VALUES (2, 'video-2', 1, 'Skip this', '2024-07-02T00:00:00Z', '2024-07-02T00:00:00Z', '', '', 0);
+"""
+
+
+def baseline(path):
+    """Create a database from before migrations were tracked, with some data."""
+
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE)
+
+
+def applied(path):
+    with sqlite3.connect(path) as connection:
+        return [row[0] for row in connection.execute('SELECT "name" FROM "migration"')]
+
+
+def test_older_database_records_untracked_migrations(tmp_path):
+    path = tmp_path / "yrss2.db"
+
+    # A database from before migrations were tracked has tables but no migration table
+    baseline(path)
+
+    result = migrate(path)
+    assert result.returncode == 0, result.stderr
+    assert "Recorded migrations that were applied before" in result.stderr
+
+    import migrate as migrate_module
+
+    assert sorted(applied(path)) == migrate_module.available()
+
+
+def test_older_database_data_is_migrated(tmp_path):
+    path = tmp_path / "yrss2.db"
+    baseline(path)
+
+    result = migrate(path)
+    assert result.returncode == 0, result.stderr
+
+    with sqlite3.connect(path) as connection:
+        # Timelines are backfilled (with filters applied)
+        assert connection.execute('SELECT "video_id" FROM "timeline"').fetchall() == [
+            (1,)
+        ]
+        assert connection.execute(
+            'SELECT "feed_id", "videos" FROM "feedstats"'
+        ).fetchall() == [(1, 2)]
+
+
+def test_new_database_applies_every_migration(tmp_path):
+    path = tmp_path / "yrss2.db"
+
+    result = migrate(path)
+    assert result.returncode == 0, result.stderr
+    assert "Recorded migrations" not in result.stderr
+
+    import migrate as migrate_module
+
+    assert sorted(applied(path)) == migrate_module.available()
+
+
+def test_concurrent_processes_apply_each_migration_once(tmp_path):
+    path = tmp_path / "yrss2.db"
+    env = dict(os.environ, YRSS_DB=str(path), YRSS_CACHE_DB=str(path) + ".cache")
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", MIGRATE],
+            cwd=ROOT,
+            env=env,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(4)
+    ]
+    logs = [process.communicate(timeout=60)[1] for process in processes]
+
+    assert [process.returncode for process in processes] == [0] * 4, logs
+
+    import migrate as migrate_module
+
+    # Each migration was applied by exactly one of the processes
+    for name in migrate_module.available():
+        assert sum(log.count(f"Applying migration {name}") for log in logs) == 1
+    assert sorted(applied(path)) == migrate_module.available()
+
+
+def test_explain(tmp_path):
+    path = tmp_path / "yrss2.db"
+    explain = "import migrate, models, sys; models.init(); sys.exit(migrate.explain())"
+
+    # Nothing to check until there are videos
+    assert migrate(path).returncode == 0
+    result = migrate(path, explain)
+    assert result.returncode == 0, result.stdout
+    assert "database with videos" in result.stderr
+
+    path = tmp_path / "baseline.db"
+    baseline(path)
+    assert migrate(path).returncode == 0
+    result = migrate(path, explain)
+    assert result.returncode == 0, result.stdout
+    assert "Lease.claim" in result.stdout
@@ -0,0 +1,82 @@
+import datetime
+import threading
+import time
+
+import models
+from factories import create, make_feed, make_user
+
+
+def reload(user):
+    return models.User.get_by_id(user.id)
+
+
+def test_filters_stay_compiled_when_subscribed_feeds_refresh(db):
+    user = make_user()
+    feed = make_feed(videos=2)
+    create(models.Subscription, user=user, feed=feed)
+    create(models.Filter, user=user, feed=feed, filter="Video 1", whitelist=False)
+
+    video = models.Video.get(youtube_id="UC0-1")
+    assert reload(user).filtered(video)
+
+    # Storing videos marks every subscriber's feed as changed, but not their filters
+    models.User.touch_subscribers([feed.id])
+    user = reload(user)
+    with models.count_queries() as queries:
+        assert user.filtered(video)
+    assert queries.count == 0
+
+
+def test_changing_filters_recompiles_them(db):
+    user = make_user()
+    feed = make_feed(videos=2)
+    create(models.Subscription, user=user, feed=feed)
+    filter = create(
+        models.Filter, user=user, feed=feed, filter="Video 1", whitelist=False
+    )
+
+    video = models.Video.get(youtube_id="UC0-0")
+    assert not reload(user).filtered(video)
+
+    filter.filter = "Video 0"
+    models.db_writer.write(filter.save)
+    reload(user).touch_filters()
+
+    assert reload(user).filtered(video)
+
+
+def test_rebuild_keeps_videos_added_while_it_runs(db):
+    user = make_user()
+    feed = make_feed(videos=2)
+    create(models.Subscription, user=user, feed=feed)
+
+    # A refresh is storing a new video while the timeline is rebuilt
+    stored = threading.Event()
+
+    def refresh():
+        stored.wait(5)
+        create(
+            models.Video,
+            youtube_id="UC0-new",
+            feed=feed,
+            title="New video",
+            published="2026-10-18T00:00:00Z",
+            updated=datetime.datetime.now(),
+            description="",
+            thumbnail="thumbnail",
+            short=False,
+        )
+        models.Timeline.add_videos(feed, ["UC0-new"])
+
+    refreshing = threading.Thread(target=models.db_writer.write, args=(refresh,))
+    refreshing.start()
+    rebuilding = threading.Thread(target=models.Timeline.rebuild, args=(user,))
+    rebuilding.start()
+
+    time.sleep(0.2)
+    stored.set()
+    refreshing.join()
+    rebuilding.join()
+
+    timeline = models.Timeline.select().where(models.Timeline.user == user.id)
+    assert {row.video.youtube_id for row in timeline} == {"UC0-0", "UC0-1", "UC0-new"}
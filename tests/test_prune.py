@@ -0,0 +1,45 @@
+import models
+import prune
+from factories import create, make_feed, make_user
+
+
+def test_prune_removes_unused_feeds_and_detaches_filtered_ones(db):
+    user = make_user()
+    subscribed = make_feed("UC0", videos=2)
+    unused = make_feed("UC1", videos=2)
+    filtered = make_feed("UC2", videos=2)
+    create(models.Subscription, user=user, feed=subscribed)
+    create(models.Filter, user=user, feed=filtered, filter="x", whitelist=False)
+
+    counts = prune.prune()
+
+    assert counts == {"deleted_feeds": 1, "detached_feeds": 1, "videos": 4}
+    assert models.Feed.get_or_none(id=unused.id) is None
+    assert models.Feed.get_by_id(filtered.id).etag is None
+    assert models.Video.select().where(models.Video.feed == subscribed).count() == 2
+    assert models.Video.select().where(models.Video.feed == filtered).count() == 0
+
+    # Detached feeds have nothing left to remove, so they aren't counted again
+    assert prune.prune() == {"deleted_feeds": 0, "detached_feeds": 0, "videos": 0}
+
+
+def test_prune_keeps_feeds_subscribed_to_after_they_were_found(db):
+    user = make_user()
+    feed = make_feed("UC0", videos=2)
+
+    # Subscribed to between finding unused feeds and removing them
+    create(models.Subscription, user=user, feed=feed)
+    removed = models.db_writer.write(prune._remove, [feed.id], set(), {feed.id})
+
+    assert removed == 0
+    assert models.Feed.get_or_none(id=feed.id) is not None
+    assert models.Video.select().where(models.Video.feed == feed).count() == 2
+
+
+def test_prune_dry_run_removes_nothing(db):
+    make_feed("UC0", videos=3)
+
+    counts = prune.prune(dry_run=True)
+
+    assert counts == {"deleted_feeds": 1, "detached_feeds": 0, "videos": 3}
+    assert models.Video.select().count() == 3
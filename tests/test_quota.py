@@ -0,0 +1,110 @@
+import pytest
+
+import quota
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def today(monkeypatch):
+    """The quota day and how far into it we are, as [day, seconds] (change to move on)."""
+
+    now = ["2026-10-18", 0]
+    monkeypatch.setattr(quota, "_today", lambda: tuple(now))
+    return now
+
+
+def budget(**options):
+    return quota.Budget(
+        **{"daily": 10000, "reserve": 1000, "burst": 500, "sync_time": DAY, **options}
+    )
+
+
+def spend_refreshing(budget, units):
+    with budget.refreshing():
+        budget.spend("videos", units)
+
+
+def test_refreshes_earn_their_allowance_through_the_day(db, today):
+    quotas = budget()
+    assert quotas.allowance(quota.REFRESH) == 500
+
+    today[1] = DAY / 2
+    assert quotas.allowance(quota.REFRESH) == 9000 / 2 + 500
+
+    spend_refreshing(quotas, 4000)
+    assert quotas.allowance(quota.REFRESH) == 1000
+
+    with pytest.raises(quota.QuotaExceeded):
+        spend_refreshing(quotas, 1001)
+
+
+def test_reserve_is_kept_for_interactive_requests(db, today):
+    quotas = budget()
+    today[1] = DAY - 1
+
+    spend_refreshing(quotas, 9000)
+    assert quotas.allowance(quota.REFRESH) == 0
+    assert quotas.allowance(quota.INTERACTIVE) == 1000
+
+    with pytest.raises(quota.QuotaExceeded):
+        spend_refreshing(quotas, 1)
+
+    quotas.spend("channels", 1000)
+    with pytest.raises(quota.QuotaExceeded):
+        quotas.spend("channels", 1)
+
+    assert quotas.spent() == {quota.INTERACTIVE: 1000, quota.REFRESH: 9000}
+
+
+def test_usage_resets_each_day(db, today):
+    quotas = budget()
+    spend_refreshing(quotas, 500)
+    assert quotas.allowance(quota.REFRESH) == 0
+
+    today[:] = ["2026-10-19", 0]
+    assert quotas.allowance(quota.REFRESH) == 500
+    assert quotas.spent() == {quota.INTERACTIVE: 0, quota.REFRESH: 0}
+
+
+def test_exhausted_until_the_next_day(db, today):
+    quotas = budget()
+    quotas.exhaust()
+
+    assert quotas.allowance(quota.REFRESH) == 0
+    with pytest.raises(quota.QuotaExceeded):
+        quotas.spend("channels", 1)
+
+    today[:] = ["2026-10-19", 0]
+    assert quotas.allowance(quota.INTERACTIVE) == 10000
+
+
+def test_unlimited(db, today):
+    quotas = budget(daily=0)
+    spend_refreshing(quotas, 100000)
+    assert quotas.allowance(quota.REFRESH) == float("inf")
+
+
+def test_usage_is_shared_between_processes(db, today):
+    # Each budget stands in for a separate process using the same database
+    first = budget()
+    second = budget()
+    today[1] = DAY / 2
+
+    spend_refreshing(first, 3000)
+    second.spend("channels", 200)
+    assert second.spent() == {quota.INTERACTIVE: 200, quota.REFRESH: 0}
+
+    first.sync()
+    second.sync()
+    assert second.spent() == {quota.INTERACTIVE: 200, quota.REFRESH: 3000}
+    assert second.allowance(quota.REFRESH) == 5000 - 3000
+
+    # Spending since the last sync is kept when reloading
+    spend_refreshing(second, 100)
+    first.sync()
+    assert second.spent() == {quota.INTERACTIVE: 200, quota.REFRESH: 3100}
+
+    second.sync()
+    first.sync()
+    assert first.spent() == second.spent()
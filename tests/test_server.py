@@ -0,0 +1,107 @@
+import email.utils
+
+import pytest
+
+import models
+import server
+from factories import create, make_feed, make_user
+
+
+@pytest.fixture
+def client(db):
+    server.rendered_feeds.clear()
+    return server.create_app().test_client()
+
+
+@pytest.fixture
+def user(db):
+    """A user subscribed to a few feeds with a few videos each."""
+
+    user = make_user()
+    for index in range(3):
+        feed = make_feed(f"UC{index}", videos=5)
+        create(models.Subscription, user=user, feed=feed)
+
+    models.Timeline.rebuild(user)
+    return models.User.get_by_id(user.id)
+
+
+def get(client, path, **headers):
+    """Make a request, returning the response and how many queries it ran."""
+
+    before = dict(server.request_queries.values)
+    response = client.get(path, headers=headers)
+    response.get_data()
+    response.close()
+
+    after = server.request_queries.values
+    queries = sum(after.values()) - sum(before.values())
+    return response, queries
+
+
+def test_feed_render_queries(client, user):
+    path = f"/feed/{user.feed_uuid}.xml"
+
+    # The user, the logged in user (none here), and every video with its feed at once
+    response, queries = get(client, path)
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count("<entry>") == 15
+    assert queries == 3
+
+    # Rendered feeds are cached until the user's feed changes
+    cached, queries = get(client, path)
+    assert cached.get_data() == response.get_data()
+    assert queries == 2
+
+    user.touch()
+    _, queries = get(client, path)
+    assert queries == 3
+
+
+def test_feed_queries_dont_grow_with_videos(client, user):
+    path = f"/feed/{user.feed_uuid}.xml"
+    _, queries = get(client, path)
+
+    feed = make_feed("UC9", videos=20)
+    create(models.Subscription, user=user, feed=feed)
+    models.Timeline.rebuild(user, [feed.id])
+    user.touch()
+
+    response, more_queries = get(client, path)
+    assert response.get_data(as_text=True).count("<entry>") == 35
+    assert more_queries == queries
+
+
+def test_feed_not_modified_by_etag(client, user):
+    path = f"/feed/{user.feed_uuid}.xml"
+    response, _ = get(client, path)
+
+    not_modified, queries = get(
+        client, path, **{"If-None-Match": response.headers["ETag"]}
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b""
+    assert queries == 2
+
+    # Once the feed changes, the old etag no longer matches
+    user.touch()
+    modified, _ = get(client, path, **{"If-None-Match": response.headers["ETag"]})
+    assert modified.status_code == 200
+    assert modified.headers["ETag"] != response.headers["ETag"]
+
+
+def test_feed_not_modified_since(client, user):
+    path = f"/feed/{user.feed_uuid}.xml"
+    response, _ = get(client, path)
+    last_modified = response.headers["Last-Modified"]
+
+    not_modified, queries = get(client, path, **{"If-Modified-Since": last_modified})
+    assert not_modified.status_code == 304
+    assert queries == 2
+
+    earlier = email.utils.format_datetime(
+        email.utils.parsedate_to_datetime(last_modified).replace(year=2000),
+        usegmt=True,
+    )
+    modified, _ = get(client, path, **{"If-Modified-Since": earlier})
+    assert modified.status_code == 200
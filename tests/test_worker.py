@@ -0,0 +1,183 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import models
+import quota
+import worker
+from factories import create, make_feed, make_user
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture
+def claimed(monkeypatch):
+    """Record what each run of a worker claims, rather than refreshing it."""
+
+    claims = []
+    monkeypatch.setattr(
+        worker, "refresh_leased", lambda name, ids, *args: claims.append(ids)
+    )
+    return claims
+
+
+def make_due_feeds(activity):
+    """Subscribed feeds that came due in order, with uploads in the last 30 days."""
+
+    user = make_user()
+    now = datetime.datetime.now()
+    feeds = []
+
+    for index, videos in enumerate(activity):
+        feed = make_feed(f"UC{index}")
+        models.db_writer.write(
+            models.Feed.update(
+                next_refresh=now - datetime.timedelta(hours=len(activity) - index)
+            )
+            .where(models.Feed.id == feed.id)
+            .execute
+        )
+        create(models.Subscription, user=user, feed=feed)
+        if videos is not None:
+            create(models.FeedStats, feed=feed, videos_30_days=videos, videos=videos)
+        feeds.append(feed.id)
+
+    return feeds
+
+
+def test_claims_longest_due_first(db, claimed, monkeypatch):
+    monkeypatch.setattr(quota, "budget", quota.Budget(daily=0))
+    feeds = make_due_feeds([0, 5, 1])
+
+    assert worker.Worker("worker", batch_size=2).run_once() == 2
+    assert claimed == [feeds[:2]]
+
+
+def test_claims_most_active_first_when_short_of_quota(db, claimed, monkeypatch):
+    # Not enough quota for every due feed
+    monkeypatch.setattr(
+        quota, "budget", quota.Budget(daily=1000, reserve=1000, burst=0)
+    )
+    feeds = make_due_feeds([0, 5, None, 1])
+
+    # Feeds that haven't been fetched yet come first, as in refresh.within_budget
+    assert worker.Worker("worker", batch_size=3).run_once() == 3
+    assert claimed == [[feeds[2], feeds[1], feeds[3]]]
+
+
+def leases():
+    return {lease.feed_id: lease for lease in models.Lease.select()}
+
+
+def test_leased_feeds_are_not_claimed_again_until_they_expire(db):
+    feeds = make_due_feeds([0, 0])
+
+    assert models.Lease.claim("first", lease_time=60) == feeds
+    assert models.Lease.claim("second") == []
+
+    # The first worker died without releasing its leases
+    models.db_writer.write(models.Lease.update(expires=datetime.datetime.now()).execute)
+    assert models.Lease.claim("second", limit=1) == feeds[:1]
+    assert {id: lease.worker for id, lease in leases().items()} == {
+        feeds[0]: "second",
+        feeds[1]: "first",
+    }
+
+
+def test_workers_only_renew_and_release_their_own_leases(db):
+    feeds = make_due_feeds([0, 0])
+    models.Lease.claim("first", limit=1, lease_time=60)
+    models.Lease.claim("second", limit=1, lease_time=60)
+    expires = leases()[feeds[1]].expires
+
+    models.Lease.renew("first", lease_time=120)
+    assert leases()[feeds[0]].expires > expires
+    assert leases()[feeds[1]].expires == expires
+
+    models.Lease.release("first", feeds)
+    assert {id: lease.worker for id, lease in leases().items()} == {feeds[1]: "second"}
+
+
+def test_leases_are_renewed_while_refreshing(db, monkeypatch):
+    feeds = make_due_feeds([0, 0])
+    ids = models.Lease.claim("worker", lease_time=0.3)
+    expires = leases()[feeds[0]].expires
+
+    renewed = []
+
+    def refresh_all(feeds, workers):
+        time.sleep(0.35)
+        renewed.append(leases()[feeds[0].id].expires > expires)
+        raise RuntimeError("refresh failed")
+
+    monkeypatch.setattr(worker.refresh, "refresh_all", refresh_all)
+    with pytest.raises(RuntimeError):
+        worker.refresh_leased("worker", ids, workers=1, lease_time=0.3)
+
+    assert renewed == [True]
+
+    # Released even though the refresh failed
+    assert leases() == {}
+
+
+CLAIM = """
+import json, models, sys
+models.init()
+
+claimed = []
+while ids := models.Lease.claim(sys.argv[1], limit=3):
+    claimed.extend(ids)
+print(json.dumps(claimed))
+"""
+
+SETUP = """
+import migrate, models
+models.init()
+migrate.run()
+
+def setup():
+    user = models.User.insert(email="user@example.com", password="password").execute()
+    for index in range(60):
+        feed = models.Feed.insert(
+            youtube_id=f"UC{index}", title="", logo="", description="", uploads_id=""
+        ).execute()
+        models.Subscription.insert(user=user, feed=feed).execute()
+
+models.db_writer.write(setup)
+"""
+
+
+def test_concurrent_workers_never_claim_the_same_feed(tmp_path):
+    env = dict(
+        os.environ,
+        YRSS_DB=str(tmp_path / "yrss2.db"),
+        YRSS_CACHE_DB=str(tmp_path / "cache.db"),
+    )
+
+    setup = subprocess.run(
+        [sys.executable, "-c", SETUP], cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    assert setup.returncode == 0, setup.stderr
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", CLAIM, f"worker-{index}"],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for index in range(4)
+    ]
+    results = [process.communicate(timeout=60) for process in processes]
+    assert [process.returncode for process in processes] == [0] * 4, results
+
+    claimed = [id for stdout, _ in results for id in json.loads(stdout)]
+    assert len(claimed) == 60
+    assert sorted(set(claimed)) == sorted(claimed)
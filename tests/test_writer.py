@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+
+import peewee
+import pytest
+
+import writer
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = peewee.SqliteDatabase(
+        str(tmp_path / "writer.db"),
+        check_same_thread=False,
+        pragmas={"journal_mode": "wal", "busy_timeout": 100},
+    )
+    database.execute_sql('CREATE TABLE "item" ("value" INTEGER NOT NULL)')
+    yield database
+    database.close()
+
+
+def insert(database, value):
+    return database.execute_sql('INSERT INTO "item" VALUES (?)', (value,)).lastrowid
+
+
+def values(database):
+    return sorted(row[0] for row in database.execute_sql('SELECT "value" FROM "item"'))
+
+
+def test_jobs_queued_together_are_batched(database):
+    db_writer = writer.Writer(database)
+    batches = []
+    run_batch = db_writer._run_batch
+    db_writer._run_batch = lambda jobs: (batches.append(len(jobs)), run_batch(jobs))
+
+    # Hold the writer in its first batch while the rest queue up behind it
+    started = threading.Event()
+    release = threading.Event()
+    first = db_writer.submit(lambda: (started.set(), release.wait()))
+    started.wait()
+
+    futures = [db_writer.submit(insert, database, value) for value in range(5)]
+    release.set()
+
+    first.result(timeout=5)
+    for future in futures:
+        future.result(timeout=5)
+
+    assert batches == [1, 5]
+    assert values(database) == [0, 1, 2, 3, 4]
+
+
+def test_failing_job_is_rolled_back_alone(database):
+    db_writer = writer.Writer(database)
+
+    def fail():
+        insert(database, 100)
+        raise ValueError("nope")
+
+    started = threading.Event()
+    release = threading.Event()
+    db_writer.submit(lambda: (started.set(), release.wait()))
+    started.wait()
+
+    before = db_writer.submit(insert, database, 1)
+    failing = db_writer.submit(fail)
+    after = db_writer.submit(insert, database, 2)
+    release.set()
+
+    with pytest.raises(ValueError):
+        failing.result(timeout=5)
+    before.result(timeout=5)
+    after.result(timeout=5)
+
+    assert values(database) == [1, 2]
+
+
+def test_write_fails_rather_than_hanging_when_locked(database, tmp_path):
+    db_writer = writer.Writer(database)
+
+    # Another process holds the write lock
+    other = sqlite3.connect(str(tmp_path / "writer.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+
+    try:
+        future = db_writer.submit(insert, database, 1)
+        with pytest.raises(peewee.OperationalError, match="locked"):
+            future.result(timeout=5)
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    # Once the lock is released, writes go through again
+    db_writer.write(insert, database, 2)
+    assert values(database) == [2]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Refresh feeds in a separate process from the web server.
+
+Any number of workers can be run against the same database. Each one claims batches
+of due feeds through the lease table (see models.Lease), so no two workers refresh
+the same feed, and feeds leased to a worker that dies are picked up by the others.
+Workers also resume subscription imports that were interrupted (see importer.resume).
+
+Usage: worker.py [--batch-size N] [--workers N]  (or: yrss2.py worker)
+"""
+
+import argparse
+import datetime
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+import importer
+import models
+import quota
+import refresh
+
+YRSS_WORKER_BATCH = int(os.getenv("YRSS_WORKER_BATCH", 50))  # feeds per claim
+YRSS_WORKER_POLL_TIME = int(
+    os.getenv("YRSS_WORKER_POLL_TIME", 30)
+)  # seconds to wait when nothing is due
+
+
+def worker_name(role="worker"):
+    return f"{socket.gethostname()}:{os.getpid()}:{role}"
+
+
+def refresh_leased(name, ids, workers, lease_time=models.YRSS_LEASE_TIME):
+    """
+    Refresh and reschedule feeds that have been leased to name, then release them.
+
+    The leases are renewed in the background until the refresh is done. Returns the
+    feeds that were refreshed.
+    """
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_time / 3):
+            try:
+                models.Lease.renew(name, lease_time)
+            except Exception as ex:
+                logging.warning(f"Exception renewing leases for {name} ({ex})")
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        feeds = []
+        for batch in models.chunked(ids, 500):
+            feeds.extend(models.Feed.select().where(models.Feed.id.in_(batch)))
+
+        refresh.refresh_all(feeds, workers=workers)
+
+        for feed in feeds:
+            feed.schedule()
+
+        return feeds
+
+    finally:
+        stop.set()
+        models.Lease.release(name, ids)
+
+
+class Worker:
+    """Claim, refresh and release batches of due feeds until stopped."""
+
+    def __init__(
+        self,
+        name=None,
+        batch_size=YRSS_WORKER_BATCH,
+        workers=refresh.YRSS_REFRESH_WORKERS,
+        lease_time=models.YRSS_LEASE_TIME,
+    ):
+        self.name = name or worker_name()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.lease_time = lease_time
+
+    def short_of_quota(self):
+        """Whether there's less refresh quota left than every due feed would need."""
+
+        allowance = quota.budget.allowance(quota.REFRESH)
+        if allowance == math.inf:
+            return False
+
+        due = models.Lease.due_query(datetime.datetime.now()).count()
+        return quota.estimate(due) > allowance
+
+    def run_once(self):
+        """
+        Refresh one batch of due feeds, returning how many were claimed.
+
+        When there isn't enough quota for every due feed, the most active are claimed
+        first, so the ones that are deferred (see refresh.within_budget) are the least
+        active of them all rather than of this batch.
+        """
+
+        ids = models.Lease.claim(
+            self.name,
+            limit=self.batch_size,
+            lease_time=self.lease_time,
+            by_activity=self.short_of_quota(),
+        )
+        if ids:
+            refresh_leased(self.name, ids, self.workers, self.lease_time)
+
+        return len(ids)
+
+    def run(self):
+        logging.info(f"Starting refresh worker {self.name}")
+
+        while True:
+            # Imports run in whichever process they were started in, so pick up any
+            # whose process has stopped
+            try:
+                importer.resume()
+            except Exception as ex:
+                logging.warning(f"Exception resuming imports in {self.name} ({ex})")
+
+            try:
+                claimed = self.run_once()
+            except Exception as ex:
+                logging.warning(f"Exception in worker {self.name} ({ex})")
+                claimed = 0
+
+            # Keep going while there's a backlog, otherwise wait for more to come due
+            if claimed < self.batch_size:
+                time.sleep(YRSS_WORKER_POLL_TIME)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=YRSS_WORKER_BATCH)
+    parser.add_argument("--workers", type=int, default=refresh.YRSS_REFRESH_WORKERS)
+    args = parser.parse_args(args)
+
+    Worker(batch_size=args.batch_size, workers=args.workers).run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
+    models.init()
+
+    main()
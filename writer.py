@@ -0,0 +1,101 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+
+YRSS_WRITE_BATCH = int(os.getenv("YRSS_WRITE_BATCH", 32))  # jobs per transaction
+
+
+class Writer:
+    """
+    Run every database write on a single thread.
+
+    Callers submit jobs (functions that make their writes through the models as usual)
+    and get back a future. The writer thread owns its own connection and runs whatever
+    jobs are queued, up to batch_size at a time, in one short transaction, so writers
+    in this process never wait on each other for SQLite's lock. Each job runs in its
+    own savepoint, so a failing job is rolled back (and its future gets the exception)
+    without affecting the rest of the batch. Futures are only resolved once the
+    transaction has committed.
+
+    The thread is started on first use.
+    """
+
+    def __init__(self, database, batch_size=YRSS_WRITE_BATCH):
+        self.database = database
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="writer", daemon=True
+                )
+                self.thread.start()
+
+    def submit(self, f, *args, **kwargs):
+        """Queue a write job, returning a future for its result."""
+
+        future = concurrent.futures.Future()
+
+        # Jobs that write more are run inline, as part of the current batch
+        if threading.current_thread() is self.thread:
+            future.set_result(f(*args, **kwargs))
+            return future
+
+        self.start()
+        self.queue.put((future, f, args, kwargs))
+        return future
+
+    def write(self, f, *args, **kwargs):
+        """Run a write job and wait for it to be committed."""
+
+        return self.submit(f, *args, **kwargs).result()
+
+    def _run(self):
+        self.database.connect(reuse_if_open=True)
+
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._run_batch(jobs)
+
+    def _run_batch(self, jobs):
+        results = []
+
+        try:
+            # Take the write lock up front, as every batch writes (and reads may
+            # otherwise need to be retried if another process writes in between)
+            with self.database.atomic("IMMEDIATE"):
+                for future, f, args, kwargs in jobs:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+
+                    try:
+                        with self.database.atomic():
+                            results.append((future, f(*args, **kwargs), None))
+                    except Exception as ex:
+                        results.append((future, None, ex))
+
+        except Exception as ex:
+            # Including jobs that never ran (if the transaction couldn't even begin)
+            logging.warning(f"Exception committing {len(jobs)} writes ({ex})")
+            for future, _, _, _ in jobs:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for future, result, exception in results:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
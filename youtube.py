@@ -1,30 +1,115 @@
-import cachetools
 import datetime
 import logging
 import os
-import requests
+
+import httpclient
+import metrics
+import quota
+from cache import cache
 
 YRSS_CACHE_TIME = int(os.getenv("YRSS_CACHE_TIME", 60 * 60))  # default = 1 hour
 YRSS_API_KEY = os.getenv("YRSS_API_KEY", None)
 
+# Where to send requests (these can be pointed at a stub server, see bench/stub.py)
+YRSS_YOUTUBE_API_URL = os.getenv(
+    "YRSS_YOUTUBE_API_URL", "https://www.googleapis.com/youtube/v3/"
+)
+YRSS_YOUTUBE_URL = os.getenv("YRSS_YOUTUBE_URL", "https://www.youtube.com/")
 
-def _all(endpoint, **params):
-    url = "https://www.googleapis.com/youtube/v3/" + endpoint.strip("/")
+CHANNELS_PER_REQUEST = 50
+VIDEOS_PER_REQUEST = 50
+
+# Every list request costs one unit of quota, even if it's not modified
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COST = 1
+
+api_requests = metrics.Counter(
+    "yrss_youtube_requests_total", "YouTube API requests", ["endpoint", "status"]
+)
+api_quota = metrics.Counter(
+    "yrss_youtube_quota_units_total",
+    "Estimated YouTube API quota units spent",
+    ["endpoint"],
+)
+shorts_probes = metrics.Counter(
+    "yrss_shorts_probes_total",
+    "Requests made to check if a video is a short",
+    ["result"],
+)
+
+
+class NotModified(Exception):
+    """Raised by a conditional request when the resource hasn't changed since the given etag."""
+
+
+def _page(endpoint, etag=None, **params):
+    """
+    Fetch a single page of results from the API.
+
+    If an etag from a previous response is given, the request is conditional and raises
+    NotModified rather than returning the same results again. Each request is charged to
+    the quota budget first (see quota.Budget).
+    """
+
+    url = YRSS_YOUTUBE_API_URL.rstrip("/") + "/" + endpoint.strip("/")
     logging.debug(url, params)
 
+    # Raises QuotaExceeded if there isn't enough left for this request
+    quota.budget.spend(endpoint.strip("/"), QUOTA_COST)
+
     params.setdefault("key", YRSS_API_KEY)
-    try:
-        result = requests.get(url, params=params).json()
+    headers = {"If-None-Match": etag} if etag else {}
 
-        # if result['pageInfo']['totalResults'] > result['pageInfo']['resultsPerPage']:
-        #    logging.debug('TODO: implement paging')
+    result = None
+    status = "error"
+    try:
+        response = httpclient.get(url, params=params, headers=headers)
+        status = response.status_code
+        if response.status_code == 304:
+            raise NotModified(url)
+        if response.status_code == 403 and "quotaExceeded" in response.text:
+            quota.budget.exhaust()
+
+        # Errors don't have any items (and are logged below)
+        result = response.json()
+        if "items" not in result:
+            raise KeyError("items")
 
-        for item in result["items"]:
-            yield item
+        return result
+    except NotModified:
+        raise
     except Exception as ex:
         logging.error(ex)
         logging.error(result)
         raise ex
+    finally:
+        api_requests.inc(endpoint=endpoint.strip("/"), status=status)
+        if status != "error":
+            api_quota.inc(QUOTA_COST, endpoint=endpoint.strip("/"))
+
+
+def _pages(endpoint, etag=None, **params):
+    """
+    Lazily yield each page of results from the API, following nextPageToken.
+
+    Only the first page is conditional on etag (see _page).
+    """
+
+    while True:
+        result = _page(endpoint, etag=etag, **params)
+        yield result
+
+        if not result.get("nextPageToken"):
+            return
+
+        params["pageToken"] = result["nextPageToken"]
+        etag = None
+
+
+def _all(endpoint, **params):
+    for result in _pages(endpoint, **params):
+        for item in result["items"]:
+            yield item
 
 
 def _one(endpoint, **params):
@@ -32,7 +117,7 @@ def _one(endpoint, **params):
         return result
 
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1024, ttl=YRSS_CACHE_TIME))
+@cache.cached(ttl=YRSS_CACHE_TIME)
 def get_id(id):
     print(id)
     if len(id) == 24:
@@ -41,33 +126,108 @@ def get_id(id):
         return get_channel_id_for_username(id)
 
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1024, ttl=YRSS_CACHE_TIME))
+@cache.cached(ttl=YRSS_CACHE_TIME)
 def get_channel_id_for_username(username):
     return _one("/channels", part="snippet", forUsername=username)["id"]
 
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1024, ttl=YRSS_CACHE_TIME))
 def get_channel(id):
-    data = _one("/channels", part="snippet,contentDetails", id=id)
-
+    return get_channels([id])[id]
+
+
+def get_channels(ids):
+    """
+    Get metadata for many channels at once.
+
+    The API accepts up to 50 ids per request, so this makes one request per 50 channels
+    that aren't already cached. Returns a dict of channel id to metadata, channels that
+    couldn't be found are left out.
+    """
+
+    channels = {}
+    missing = []
+
+    for id in dict.fromkeys(ids):
+        data = cache.get(f"channel:{id}")
+        if data:
+            channels[id] = data
+        else:
+            missing.append(id)
+
+    for i in range(0, len(missing), CHANNELS_PER_REQUEST):
+        batch = missing[i : i + CHANNELS_PER_REQUEST]
+
+        for data in _all(
+            "/channels",
+            part="snippet,contentDetails",
+            id=",".join(batch),
+            maxResults=CHANNELS_PER_REQUEST,
+        ):
+            channels[data["id"]] = {
+                "youtube_id": data["id"],
+                "title": data["snippet"]["title"],
+                "updated": datetime.datetime.now(),
+                "logo": data["snippet"]["thumbnails"]["default"]["url"],
+                "description": data["snippet"]["description"],
+                "uploads_id": data["contentDetails"]["relatedPlaylists"]["uploads"],
+            }
+
+            cache.set(f"channel:{data['id']}", channels[data["id"]], YRSS_CACHE_TIME)
+
+    return channels
+
+
+def get_video_pages(id, etag=None):
+    """
+    Lazily yield the videos in a playlist, newest first, as (etag, videos) pages.
+
+    Each page is only requested once the previous one has been consumed, so callers
+    can stop as soon as they've seen enough. If etag is given (from the first page of
+    a previous call) and the playlist hasn't changed since, raises NotModified instead.
+    """
+
+    for result in _pages(
+        "/playlistItems",
+        etag=etag,
+        part="snippet",
+        maxResults=VIDEOS_PER_REQUEST,
+        playlistId=id,
+    ):
+        yield result.get("etag"), [_video(video) for video in result["items"]]
+
+
+def _video(video):
     return {
-        "youtube_id": id,
-        "title": data["snippet"]["title"],
+        "youtube_id": video["snippet"]["resourceId"]["videoId"],
+        "title": video["snippet"]["title"],
+        "published": video["snippet"]["publishedAt"],
         "updated": datetime.datetime.now(),
-        "logo": data["snippet"]["thumbnails"]["default"]["url"],
-        "description": data["snippet"]["description"],
-        "uploads_id": data["contentDetails"]["relatedPlaylists"]["uploads"],
+        "description": video["snippet"]["description"],
+        "thumbnail": video["snippet"]["thumbnails"]["high"]["url"],
     }
 
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1024, ttl=YRSS_CACHE_TIME))
-def get_videos(id):
-    for video in _all("/playlistItems", part="snippet", maxResults=20, playlistId=id):
-        yield {
-            "youtube_id": video["snippet"]["resourceId"]["videoId"],
-            "title": video["snippet"]["title"],
-            "published": video["snippet"]["publishedAt"],
-            "updated": datetime.datetime.now(),
-            "description": video["snippet"]["description"],
-            "thumbnail": video["snippet"]["thumbnails"]["high"]["url"],
-        }
+def get_thumbnails(ids):
+    """Get the current (high quality) thumbnail for up to 50 videos at once."""
+
+    return {
+        video["id"]: video["snippet"]["thumbnails"]["high"]["url"]
+        for video in _all("/videos", part="snippet", id=",".join(ids), maxResults=50)
+    }
+
+
+def is_short(id):
+    """Check if a video is a short (shorts don't redirect to the normal watch page).
+
+    https://stackoverflow.com/questions/71192605/how-do-i-get-youtube-shorts-from-youtube-api-data-v3
+    """
+
+    try:
+        response = httpclient.head(f"{YRSS_YOUTUBE_URL.rstrip('/')}/shorts/{id}")
+    except Exception:
+        shorts_probes.inc(result="error")
+        raise
+
+    short = not (response.status_code >= 300 and response.status_code < 400)
+    shorts_probes.inc(result="short" if short else "video")
+    return short
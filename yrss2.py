@@ -1,66 +1,122 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+"""
+Run yrss.
+
+Usage: yrss2.py [serve]         run the web server (and refresh feeds in the background)
+       yrss2.py worker [...]    run a standalone refresh worker (see worker.py)
+       yrss2.py maintenance     prune unused feeds and update feed statistics once
+
+Importing this module has no side effects; everything is started from main.
+"""
+
 import logging
+import sys
 import threading
 import time
 import os
-import sqlite3
-
-logging.basicConfig(
-    format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
+import importer
+import migrate
 import models
+import prune
+import scheduler
 import server
+import worker
+
+YRSS_DEBUG = os.environ.get("YRSS_DEBUG", "False").lower() == "true"
+YRSS_EXTERNAL_WORKERS = (
+    os.environ.get("YRSS_EXTERNAL_WORKERS", "False").lower() == "true"
+)
+
+
+def maintenance():
+    """Remove any unused feeds and update feed statistics."""
+
+    logging.info("Pruning unused feeds")
+    try:
+        prune.prune()
+    except Exception as ex:
+        logging.warning(f"Exception pruning feeds ({ex})")
+
+    logging.info("Updating feed statistics")
+    try:
+        models.FeedStats.roll_forward()
+    except Exception as ex:
+        logging.warning(f"Exception updating feed statistics ({ex})")
+
+
+def maintenance_thread():
+    """Thread to run maintenance daily"""
+
+    while True:
+        maintenance()
+        time.sleep(24 * 60 * 60)
+
+
+def import_thread():
+    """Thread to resume imports that were interrupted, once their leases expire"""
+
+    while True:
+        try:
+            importer.resume()
+        except Exception as ex:
+            logging.warning(f"Exception resuming imports ({ex})")
+
+        time.sleep(worker.YRSS_WORKER_POLL_TIME)
+
+
+def update_thread():
+    """Thread to update each feed as it comes due"""
+
+    scheduler.Scheduler().run()
+
+
+def start_background_threads():
+    if YRSS_DEBUG:
+        logging.info("Running in debug mode, skipping update threads")
+        return
+
+    threading.Thread(target=maintenance_thread, daemon=True).start()
+
+    # Imports run in the web server, so restart any that a restart interrupted
+    threading.Thread(target=import_thread, daemon=True).start()
 
-if "YRSS_API_KEY" not in os.environ:
-    logging.error("YRSS_API_KEY environment variable is required")
-    exit(1)
+    # Feeds can be refreshed by separate worker processes instead (see worker.py)
+    if YRSS_EXTERNAL_WORKERS:
+        logging.info("Using external workers, skipping update thread")
+    else:
+        threading.Thread(target=update_thread, daemon=True).start()
 
-# Ask each user to update once per ten minutes
-if os.environ.get("YRSS_DEBUG", "False").lower() == "true":
-    logging.info("Running in debug mode, skipping update threads")
-else:
 
-    def prune_thread():
-        """Thread to remove any unused feeds"""
+def main(args):
+    logging.basicConfig(
+        format="[%(levelname)s] %(funcName)s: %(message)s", level=logging.INFO
+    )
 
-        while True:
-            logging.info("Pruning unused feeds")
-            for feed in models.Feed().select():
-                if not feed.is_used():
-                    logging.info(f"Removing unused feed: {feed}")
-                    feed.delete_instance(recursive=True)
+    if "YRSS_API_KEY" not in os.environ:
+        logging.error("YRSS_API_KEY environment variable is required")
+        sys.exit(1)
 
-                    # TODO: This will also delete filters for this feed, is this intentional?
-                    # They're not currently subscribed, but may return and then the filters are gone
+    command = args[0] if args else "serve"
 
-            time.sleep(24 * 60 * 60)
+    models.init()
+    migrate.run()
 
-    threading.Thread(target=prune_thread, daemon=True).start()
+    if command == "worker":
+        worker.main(args[1:])
 
-    def update_thread():
-        """Thread to update all feeds for all users"""
+    elif command == "maintenance":
+        maintenance()
 
-        while True:
-            logging.info("Checking feeds for updates")
-            for feed in models.Feed().select():
-                try:
-                    feed.refresh()
-                except sqlite3.OperationalError as ex:
-                    if "locked" in str(ex).lower():
-                        logging.warning(f"Database locked while refreshing {feed}, will retry later")
-                    else:
-                        logging.warning(f"Exception in refresh loop ({ex})")
-                except Exception as ex:
-                    logging.warning(f"Exception in refresh loop ({ex})")
+    elif command == "serve":
+        start_background_threads()
+        server.create_app().run(host="0.0.0.0", debug=YRSS_DEBUG, port=8001)
 
-            time.sleep(10 * 60)
+    else:
+        sys.exit(__doc__.strip())
 
-    threading.Thread(target=update_thread, daemon=True).start()
 
 if __name__ == "__main__":
-    server.app.run(host="0.0.0.0", debug=True, port=8001)
+    main(sys.argv[1:])